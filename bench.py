@@ -0,0 +1,220 @@
+""" Benchmarks for the matching and reduction engine.
+Each benchmark runs a workload built from the real rules and ingredient data, or a synthetic one scaled up
+by its parameters (more rules, longer components, bigger mixtures, bigger catalogs), and reports
+operations per second along with the memory allocated per call of the workload, as traced by tracemalloc.
+Results are saved as JSON so that runs on different commits can be compared:
+  python bench.py -o before.json
+  ...
+  python bench.py -o after.json --compare before.json
+"""
+import os, json, time, random, shutil, argparse, tempfile, platform, subprocess, timeit, tracemalloc, atexit
+import parse_ingredients, parse_reductions, condition_syntax_tree, interactive
+from component import Component, match_component_pattern
+from mixture import Mixture, ReductionRuleMixture, ReductionRuleComponentAsMixture, match_mixture_pattern
+from util import ReductionSystem
+
+BENCHMARKS = [] # list of (name, params, setup); see benchmark
+
+
+def benchmark(*param_sets):
+  """ Register the decorated function as a benchmark, once for each dict of parameters in |param_sets|.
+  The function takes a Kitchen and the parameters as keyword arguments, and returns a pair:
+  a function of no arguments running the workload, and the number of operations it performs.
+  """
+  def register(setup):
+    for params in param_sets or [{}]:
+      BENCHMARKS.append((setup.__name__, params, setup))
+    return setup
+  return register
+
+
+def modifiers_of(kitchen):
+  'Return the sorted list of modifiers that show up in the rules or are gained through actions'
+  modifiers = set(kitchen.modifier_tags)
+  for ing in kitchen.ingredients:
+    for value in ing.__dict__.values():
+      if isinstance(value,str):
+        for action in value.split(';'):
+          args = action.split()
+          if len(args)==2 and args[0]=='gain_mod':
+            modifiers.add(args[1])
+  return sorted(modifiers)
+
+def random_components(kitchen, rng, count, modifiers):
+  'Return |count| random Components with |modifiers| modifiers on a gettable ingredient'
+  pool = modifiers_of(kitchen)
+  return [Component([rng.choice(pool) for _ in range(modifiers)] + [rng.choice(kitchen.gettable_ingredients)]) for _ in range(count)]
+
+def random_mixtures(kitchen, rng, count, size, modifiers=2):
+  return [Mixture(random_components(kitchen, rng, size, rng.randint(0,modifiers))) for _ in range(count)]
+
+def component_rules(rules):
+  return [r.component_rule for r in rules if isinstance(r, ReductionRuleComponentAsMixture)]
+
+def mixture_rules(rules):
+  return [r for r in rules if isinstance(r, ReductionRuleMixture)]
+
+def synthetic_rules(count):
+  'Return |count| component rules that look like real ones but match nothing in the real data'
+  rules = []
+  for i in range(count):
+    rules.append(parse_reductions.parse_component_reduction_rule("o1 & synthetic{0} m1 i1:Ingredient -> o1 m1 i1 synthetic{0}".format(i)))
+  return [ReductionRuleComponentAsMixture(r) for r in rules]
+
+
+@benchmark({'modifiers' : 2}, {'modifiers' : 8}, {'modifiers' : 32})
+def match_component(kitchen, modifiers):
+  'Match every component rule of the real rules against random components'
+  type_checker = kitchen.type_checker
+  patterns = [r.compiled_lhs for r in component_rules(kitchen.rs.rules)]
+  components = random_components(kitchen, random.Random(0), 20, modifiers)
+  def run():
+    for pattern in patterns:
+      for component in components:
+        match_component_pattern(pattern, component, type_checker)
+  return run, len(patterns)*len(components)
+
+@benchmark({'size' : 2}, {'size' : 8}, {'size' : 32})
+def match_mixture(kitchen, size):
+  'Match every mixture rule of the real rules against random mixtures, without match memos'
+  type_checker = kitchen.type_checker
+  patterns = [r.compiled_lhs for r in mixture_rules(kitchen.rs.rules)]
+  mixtures = random_mixtures(kitchen, random.Random(0), 10, size)
+  def run():
+    for pattern in patterns:
+      for mixture in mixtures:
+        match_mixture_pattern(pattern, mixture.components, type_checker)
+  return run, len(patterns)*len(mixtures)
+
+@benchmark()
+def cst_evaluate(kitchen):
+  'Evaluate every qualifier of the real rules on the tags of every ingredient'
+  conditions = set()
+  for rule in kitchen.rs.rules + kitchen.rs_display.rules:
+    lhs_components = rule.lhs.components if isinstance(rule, ReductionRuleMixture) else [rule.component_rule.lhs]
+    for lhs in lhs_components:
+      conditions.update(token.split(':',1)[1] for token in lhs.component.tokens if ':' in token)
+  csts = [condition_syntax_tree.Cst(c) for c in sorted(conditions)]
+  truth_mappings = []
+  for tags in kitchen.type_checker.ingredient_tags.values():
+    truth_mappings.append({symbol : symbol in tags for cst in csts for symbol in cst.symbols()})
+  def run():
+    for cst in csts:
+      for truth_mapping in truth_mappings:
+        cst.evaluate(truth_mapping)
+  return run, len(csts)*len(truth_mappings)
+
+@benchmark({'ingredients' : None}, {'ingredients' : 2000})
+def parse_catalog(kitchen, ingredients):
+  'Parse the real ingredient data, or a synthetic catalog of the given size with three levels of inheritance'
+  directory = kitchen.ingredients_dir
+  if ingredients is not None:
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    bases = ["name: Base\nabstract: True\ninherit: None\nslice: nothing\n"]
+    bases += ["name: Group{}\nabstract: True\ninherit: Base\n".format(i) for i in range(20)]
+    bases += ["name: Kind{0}\nabstract: True\ninherit: Group{0}, Group{1}\n".format(i,(i+1)%20) for i in range(20)]
+    with open(os.path.join(directory,'Bases'),'w') as f:
+      f.write("---\n".join(bases))
+    for i in range(ingredients):
+      with open(os.path.join(directory,'Ing{}'.format(i)),'w') as f:
+        f.write("name: Ing{}\nabstract: False\ninherit: Kind{}\nslice: gain_mod sliced\n".format(i,i%20))
+  def run():
+    parse_ingredients.parse(directory, cache_dir=None)
+  return run, 1
+
+@benchmark(
+  {'size' : 1, 'extra_rules' : 0, 'engine' : 'fixpoint'},
+  {'size' : 4, 'extra_rules' : 0, 'engine' : 'fixpoint'},
+  {'size' : 4, 'extra_rules' : 0, 'engine' : 'agenda'},
+  {'size' : 16, 'extra_rules' : 0, 'engine' : 'fixpoint'},
+  {'size' : 16, 'extra_rules' : 0, 'engine' : 'agenda'},
+  {'size' : 4, 'extra_rules' : 200, 'engine' : 'fixpoint'},
+  {'size' : 4, 'extra_rules' : 200, 'engine' : 'agenda'},
+)
+def reduce_mixture(kitchen, size, extra_rules, engine):
+  'Reduce random mixtures with the real rules, plus |extra_rules| synthetic ones, on a warm ReductionSystem'
+  rs = ReductionSystem(synthetic_rules(extra_rules) + kitchen.reduction_rules, engine=engine)
+  rs.set_type_checker(kitchen.type_checker)
+  mixtures = random_mixtures(kitchen, random.Random(0), 20, size)
+  def run():
+    for mixture in mixtures:
+      rs.reduce_mixture(mixture)
+  return run, len(mixtures)
+
+
+def measure(run, ops, min_time=0.2, repeat=3):
+  """ Time |run|, which performs |ops| operations, and trace its allocations.
+  Return a dict with the best ops/sec over |repeat| rounds of at least |min_time| seconds,
+  and the peak and net bytes allocated by one call.
+  """
+  run() # warm up caches, so that every round measures the same thing
+  timer = timeit.Timer(run)
+  loops, elapsed = timer.autorange()
+  loops = max(1, int(loops*min_time/max(elapsed,1e-9)))
+  best = min(timer.repeat(repeat, loops))/loops
+
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  tracemalloc.reset_peak()
+  run()
+  after, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return {
+    'ops_per_sec' : ops/best,
+    'seconds_per_call' : best,
+    'peak_bytes' : peak-before,
+    'net_bytes' : after-before,
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git','rev-parse','--short','HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+def describe(name, params):
+  return name + ''.join(' {}={}'.format(k,v) for k,v in params.items())
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the matching and reduction engine")
+  parser.add_argument('-k', '--filter', default='', help="only run benchmarks whose description contains this")
+  parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per timing round")
+  parser.add_argument('--repeat', type=int, default=3, help="number of timing rounds, of which the best is taken")
+  parser.add_argument('-o', '--output', help="path of a JSON file to save the results to")
+  parser.add_argument('--compare', help="path of saved results to compare against")
+  args = parser.parse_args()
+
+  kitchen = interactive.Kitchen()
+  baseline = {}
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = {describe(r['name'],r['params']) : r for r in json.load(f)['results']}
+
+  results = []
+  for name, params, setup in BENCHMARKS:
+    description = describe(name, params)
+    if args.filter not in description: continue
+    run, ops = setup(kitchen, **params)
+    result = dict(name=name, params=params, ops=ops, **measure(run, ops, args.min_time, args.repeat))
+    results.append(result)
+    line = "{:<55} {:>12.1f} ops/sec {:>10.1f} KiB peak {:>10.1f} KiB net".format(
+      description, result['ops_per_sec'], result['peak_bytes']/1024, result['net_bytes']/1024)
+    if description in baseline:
+      line += "   x{:.2f}".format(result['ops_per_sec']/baseline[description]['ops_per_sec'])
+    print(line)
+
+  if args.output:
+    with open(args.output,'w') as f:
+      json.dump({
+        'commit' : git_commit(),
+        'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'results' : results,
+      }, f, indent=1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,96 @@
+import os, sys, pickle
+from collections import OrderedDict
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__cache__") # Default directory for files cached on disk
+
+MISSING = object() # Default returned by LRUCache.get for missing keys, since None can be a cached value
+
+
+class LRUCache:
+  """ A mapping that holds at most |maxsize| entries, evicting the least recently used entry when full.
+  It counts hits, misses and evictions; see info.
+  """
+  def __init__(self, maxsize=1024):
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=MISSING):
+    'Return the value cached for |key| and mark it as recently used, or return |default| if there is none'
+    try:
+      value = self.entries[key]
+      self.entries.move_to_end(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    'Cache |value| for |key|, evicting the least recently used entries if there are too many'
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxsize:
+      try:
+        self.entries.popitem(last=False)
+      except KeyError:
+        break
+      self.evictions += 1
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def __len__(self):
+    return len(self.entries)
+
+  def clear(self):
+    'Remove all entries. The counters are kept; see reset_counters'
+    self.entries.clear()
+
+  def reset_counters(self):
+    self.hits = self.misses = self.evictions = 0
+
+  def info(self):
+    'Return a dict of the counters, along with the current and maximum size'
+    return {
+      'hits' : self.hits,
+      'misses' : self.misses,
+      'evictions' : self.evictions,
+      'size' : len(self.entries),
+      'maxsize' : self.maxsize,
+    }
+
+
+
+def pickle_cached(cache_dir, name, digest, build):
+  """ Return build(), caching its result as a pickle file in |cache_dir|.
+  |digest| is a string identifying the inputs of build, such as a hash of the files it reads;
+  the result is only reused while the digest is the same. Older pickles of |name| are removed.
+  Problems with the cache directory are reported as warnings, and build() is used instead.
+  """
+  prefix = name+'-'
+  path = os.path.join(cache_dir, prefix+digest+'.pickle')
+  try:
+    with open(path,'rb') as f:
+      return pickle.load(f)
+  except FileNotFoundError:
+    pass
+  except Exception as e:
+    print("Warning: ignoring unreadable cache file {} ({})".format(path,e), file=sys.stderr)
+
+  result = build()
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    for filename in os.listdir(cache_dir):
+      if filename.startswith(prefix) and filename.endswith('.pickle'):
+        os.remove(os.path.join(cache_dir,filename))
+    tmp_path = '{}.{}.tmp'.format(path,os.getpid())
+    with open(tmp_path,'wb') as f:
+      pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+  except OSError as e:
+    print("Warning: could not write cache file {} ({})".format(path,e), file=sys.stderr)
+  return result
@@ -0,0 +1,193 @@
+""" Offline table of the mixtures reachable from single gettable ingredients within a few actions,
+together with their reduced forms and display forms.
+
+A table is built by running this module, e.g.
+  python closure_table.py --depth 3 -o closure_table.bin
+and is used by interactive.py when it is started with --closure-table closure_table.bin.
+Anything that is not in the table is reduced live, so the table only needs to cover the common cases.
+
+File format (little endian). Records are sorted by key so that a lookup is a binary search
+over the memory mapped file, and nothing is read into memory up front:
+  8 bytes   MAGIC
+  32 bytes  sha256 fingerprint of the data files the table was built from (see data_fingerprint)
+  4 bytes   number of records n
+  4(n+1)    offsets of the records, relative to the start of the record data
+  ...       record data; each record is key + b'\\0' + value, utf-8 encoded
+Keys are 'R|' + str(mixture) for the reduced form of a mixture, and 'D|' + str(mixture)
+for its display form. Values are string representations of mixtures.
+"""
+import os, io, mmap, struct, hashlib, argparse, contextlib, multiprocessing
+from mixture import Mixture
+
+MAGIC = b'INGCLOS1'
+HEADER = struct.Struct('<8s32sI')
+OFFSET = struct.Struct('<I')
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATHS = [os.path.join(DATA_DIR, name) for name in ['reductions', 'reductions_display', 'ingredient_data']]
+ACTIONS = ['slice', 'mush', 'strain', 'cook_flame', 'cook_boil', 'cook_fry', 'cook_bake']
+
+
+def data_fingerprint(paths=DATA_PATHS):
+  """ Return the sha256 digest of the names and contents of the files at |paths|, descending into directories.
+  Names are hashed relative to the parent of each path, so the digest does not depend on where the data is.
+  Raise an exception if one of |paths| does not exist, rather than fingerprint the data without it.
+  """
+  h = hashlib.sha256()
+  for path in paths:
+    if not os.path.exists(path):
+      raise Exception("Cannot fingerprint missing data file {}".format(os.path.abspath(path)))
+    root = os.path.dirname(os.path.abspath(path))
+    if os.path.isdir(path):
+      files = sorted(os.path.join(path,name) for name in os.listdir(path))
+    else:
+      files = [path]
+    for filepath in files:
+      if not os.path.isfile(filepath): continue
+      h.update(os.path.relpath(os.path.abspath(filepath), root).encode()+b'\0')
+      with open(filepath,'rb') as f:
+        h.update(f.read())
+  return h.digest()
+
+def kitchen_fingerprint(kitchen):
+  'Return the data_fingerprint of the data files of the interactive.Kitchen |kitchen|'
+  return data_fingerprint([kitchen.reductions_path, kitchen.reductions_display_path, kitchen.ingredients_dir])
+
+
+class ClosureTable:
+  """ Read only view of a table file, see the module docstring.
+  If |fingerprint| is given and differs from the one the table was built with, an exception is raised,
+  since the table would give reductions according to old data.
+  """
+  def __init__(self, path, fingerprint=None):
+    self.path = path
+    with open(path,'rb') as f:
+      self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, table_fingerprint, self.count = HEADER.unpack_from(self.buffer, 0)
+    if magic != MAGIC:
+      raise Exception("{} is not a closure table".format(path))
+    if fingerprint is not None and fingerprint != table_fingerprint:
+      raise Exception("Closure table {} was built from different data files and is out of date".format(path))
+    self.offsets_start = HEADER.size
+    self.data_start = self.offsets_start + OFFSET.size*(self.count+1)
+
+  def __len__(self):
+    return self.count
+
+  def record(self, i):
+    'Return the key and value of the i-th record as bytes'
+    start = self.data_start + OFFSET.unpack_from(self.buffer, self.offsets_start + OFFSET.size*i)[0]
+    end = self.data_start + OFFSET.unpack_from(self.buffer, self.offsets_start + OFFSET.size*(i+1))[0]
+    key, _, value = self.buffer[start:end].partition(b'\0')
+    return key, value
+
+  def get(self, key):
+    'Return the value for the string |key|, or None if it is not in the table'
+    key = key.encode()
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo+hi)//2
+      mid_key, value = self.record(mid)
+      if mid_key == key:
+        return value.decode()
+      if mid_key < key:
+        lo = mid+1
+      else:
+        hi = mid
+    return None
+
+  def lookup(self, kind, mixture):
+    'Return the mixture stored under |kind| (R or D) for the Mixture |mixture|, or None'
+    value = self.get(kind+'|'+str(mixture))
+    return None if value is None else Mixture(value)
+
+  def close(self):
+    self.buffer.close()
+
+
+def write_table(path, records, fingerprint):
+  'Write the dict |records| from string keys to string values as a table file at |path|'
+  items = sorted((key.encode(), value.encode()) for key,value in records.items())
+  offsets = [0]
+  for key, value in items:
+    offsets.append(offsets[-1] + len(key) + 1 + len(value))
+  tmp_path = '{}.{}.tmp'.format(path,os.getpid())
+  with open(tmp_path,'wb') as f:
+    f.write(HEADER.pack(MAGIC, fingerprint, len(items)))
+    f.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+    for key, value in items:
+      f.write(key + b'\0' + value)
+  os.replace(tmp_path, path)
+
+
+def round_trips(mixture):
+  'Whether |mixture| is nonempty and is recovered from its string representation'
+  return bool(mixture.components) and Mixture(str(mixture)) == mixture
+
+def explore(ing_name, depth):
+  """ Apply every sequence of at most |depth| actions to a food made of |ing_name|,
+  reducing after each action like interactive.Food does, and return the records for all mixtures seen.
+  Separated out components become foods of their own and are explored as well.
+  """
+  import interactive
+  kitchen = interactive.default_kitchen()
+  records = {}
+  def add_display_record(mixture):
+    display = kitchen.rs_display.reduce_mixture(mixture)
+    if round_trips(display):
+      records['D|'+str(mixture)] = str(display)
+
+  start = Mixture(ing_name)
+  add_display_record(start)
+  frontier = [start]
+  seen = set()
+  with contextlib.redirect_stdout(io.StringIO()): # actions print messages, which are not wanted here
+    for _ in range(depth):
+      next_frontier = []
+      for mixture in frontier:
+        if mixture.key() in seen: continue
+        seen.add(mixture.key())
+        for attribute in ACTIONS:
+          food = interactive.Food(Mixture(mixture), kitchen=kitchen)
+          try:
+            for component in food.mixture.components[:]:
+              food.apply_action_to_component(component, attribute)
+          except Exception:
+            continue # some ingredient lacks this action
+          results = [food.mixture] + ([Mixture(food.marked_for_separating_out)] if food.marked_for_separating_out else [])
+          for raw in results:
+            if not raw.components: continue
+            reduced = kitchen.rs.reduce_mixture(Mixture(raw))
+            if round_trips(raw) and round_trips(reduced):
+              records['R|'+str(raw)] = str(reduced)
+              add_display_record(reduced)
+              next_frontier.append(reduced)
+      frontier = next_frontier
+  return records
+
+def explore_star(args):
+  return explore(*args)
+
+
+def build(path, depth=2, processes=None):
+  'Explore all gettable ingredients in parallel and write the table to |path|. Return the number of records.'
+  import interactive
+  records = {}
+  with multiprocessing.Pool(processes) as pool:
+    for ingredient_records in pool.imap_unordered(explore_star, [(ing, depth) for ing in interactive.default_kitchen().gettable_ingredients]):
+      records.update(ingredient_records)
+  write_table(path, records, kitchen_fingerprint(interactive.default_kitchen()))
+  return len(records)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Build a table of mixtures reachable from gettable ingredients and their reduced forms")
+  parser.add_argument('-o', '--output', default='closure_table.bin', help="path of the table file to write")
+  parser.add_argument('--depth', type=int, default=2, help="maximum number of actions applied to an ingredient")
+  parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: number of cores)")
+  args = parser.parse_args()
+  count = build(args.output, args.depth, args.processes)
+  print("Wrote {} records to {}".format(count, args.output))
+
+
+if __name__ == '__main__':
+  main()
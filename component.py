@@ -1,43 +1,123 @@
-import copy
+import time
 import condition_syntax_tree
+from cache import LRUCache, MISSING
+
+
+class SymbolTable:
+  """ Interns token strings, giving each distinct string a small integer id.
+  Ids are only meaningful within one process; anything written out or sent
+  to another process should use the strings.
+  """
+  def __init__(self):
+    self.ids = {} # maps token strings to ids
+    self.strings = [] # maps ids to token strings
+
+  def intern(self, token_str):
+    'Return the id of |token_str|, assigning a new one if needed'
+    symbol = self.ids.get(token_str)
+    if symbol is None:
+      symbol = len(self.strings)
+      self.ids[token_str] = symbol
+      self.strings.append(token_str)
+    return symbol
+
+  def intern_all(self, token_strs):
+    'Return the tuple of ids of the token strings in |token_strs|'
+    return tuple(self.intern(t) for t in token_strs)
+
+  def string(self, symbol):
+    'Return the token string with id |symbol|'
+    return self.strings[symbol]
+
+  def __len__(self):
+    return len(self.strings)
+
+
+symbol_table = SymbolTable() # The SymbolTable used by all Components
 
 
 class Component:
-  """ Wraps a list of token strings.
+  """ Wraps a tuple of token ids from symbol_table.
       The initializer can be
       - a string representation of a token, which is space separated
-      - a list of tokens
+      - a list (or tuple) of token strings
       - another Component (in which case a copy is created)
+      The token strings are available through the |tokens| property, which
+      returns a new list each time. Components are immutable, since reductions and
+      caches share them: to change one, make a new Component from modified tokens.
   """
+  __slots__ = ['ids']
+
   def __init__(self,init=None):
     if init is None:
-      self.tokens = []
+      self.ids = ()
     elif isinstance(init,str):
-      self.tokens = [t.strip() for t in init.split()]
-    elif isinstance(init,list):
-      self.tokens = init
+      self.ids = symbol_table.intern_all(init.split())
+    elif isinstance(init,(list,tuple)):
+      self.ids = symbol_table.intern_all(init)
     elif isinstance(init,Component):
-      self.tokens = copy.deepcopy(init.tokens)
+      self.ids = init.ids
     else:
       raise Exception("Cannot initialize a Component with '{}', which is of type '{}'".format(init,type(init)))
 
+  @classmethod
+  def from_ids(cls, ids):
+    'Create a Component directly from a tuple of ids in symbol_table'
+    component = cls.__new__(cls)
+    component.ids = ids
+    return component
+
+  @property
+  def tokens(self):
+    return [symbol_table.strings[i] for i in self.ids]
+
   def __str__(self):
     return ' '.join(self.tokens)
 
   def __eq__(self,other):
-    return self.tokens==other.tokens
+    return isinstance(other,Component) and self.ids==other.ids
+
+  def __hash__(self):
+    return hash(self.ids)
+
+  def key(self):
+    'Return a hashable canonical form of this Component, which is just its ids'
+    return self.ids
+
+  def __copy__(self):
+    return Component.from_ids(self.ids)
+
+  def __deepcopy__(self, memo):
+    return Component.from_ids(self.ids) # ids is an immutable tuple, so it can be shared
+
+  def __reduce__(self):
+    # Pickle by token strings, since ids are specific to this process's symbol_table
+    return (Component, (self.tokens,))
 
 
 class Token:
-  'Represents a token. See TypeChecker.type_info for description of type_info tuple.'
+  """ Represents a token. See TypeChecker.type_info for description of type_info tuple.
+  |id| is the symbol_table id of the token's name.
+  """
   def __init__(self, token_str, type_info):
     self.str = token_str
     self.varness, self.category = type_info
     token_str_colon_split = token_str.split(':')
     self.name = token_str_colon_split[0]
+    self.id = symbol_table.intern(self.name)
     if self.varness == "qvar":
       self.qualifier = condition_syntax_tree.Cst(token_str_colon_split[1])
 
+  def __getstate__(self):
+    # symbol ids are specific to this process, so the name is interned again on unpickling
+    state = self.__dict__.copy()
+    del state['id']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.id = symbol_table.intern(self.name)
+
   def matches(self,const_token,type_checker):
     'Return whether this token pattern matches the |const_token|, which is a Token'
     assert(const_token.varness=='const')
@@ -52,9 +132,22 @@ class Token:
 
 
 class TypeChecker:
+  """ Gives types and tags to tokens. Subclasses implement tags_of_const and is_ingredient.
+  Subclasses need not call this initializer; the caches below are created on first use.
+  """
+  token_cache = None # see parse_component
+  tag_mask_cache = None # see tag_mask_of_const
+  qualifier_cache = None # see const_satisfies_qualifier
+  qualifier_cache_size = 4096
+  cache_names = ['token_cache', 'tag_mask_cache', 'qualifier_cache']
+
   def __init__(self):
     raise NotImplementedError
 
+  def __getstate__(self):
+    # the caches are keyed on symbol ids, which are specific to this process
+    return {k:v for k,v in self.__dict__.items() if k not in self.cache_names}
+
   def type_info(self, token_str, last=False):
     """ Return a tuple describing the type of |token_str|.
     Set |last| to True if this token is the last of its Component.
@@ -105,7 +198,7 @@ class TypeChecker:
 
 
   def tags_of_const(self, const_token):
-    """ Given a const Token, return the list of tags that apply to it.
+    """ Given a const Token, return the list (or other collection) of tags that apply to it.
     If the const token is a modifier,
       then this could be the list of tags that are somehow attached to that modifier.
     If the const token is an ingredient (used as a modifier or not),
@@ -113,6 +206,18 @@ class TypeChecker:
     """
     raise NotImplementedError
 
+  def tag_mask_of_const(self, const_token):
+    """ Return the condition_syntax_tree tag mask of the tags of const_token.
+    Tags of constants are assumed not to change, so masks are computed once per constant.
+    """
+    if self.tag_mask_cache is None:
+      self.tag_mask_cache = {}
+    key = (const_token.id, const_token.category)
+    mask = self.tag_mask_cache.get(key)
+    if mask is None:
+      mask = self.tag_mask_cache[key] = condition_syntax_tree.tag_mask(self.tags_of_const(const_token))
+    return mask
+
   def const_has_tag(self, const_token, tag):
     'Return whether the token has the tag'
     return tag in self.tags_of_const(const_token)
@@ -121,12 +226,41 @@ class TypeChecker:
     'Convert the given token string into a Token'
     return Token(token_str, self.type_info(token_str))
 
+  def parse_component(self, component):
+    """ Return the list of Tokens making up the Component |component|.
+    The Tokens are cached by symbol id and shared between calls, so they must not be modified.
+    """
+    if self.token_cache is None:
+      self.token_cache = ({}, {}) # for tokens that are not last, and for tokens that are last
+    n = len(component.ids)
+    tokens = []
+    for i,symbol in enumerate(component.ids):
+      cache = self.token_cache[i==n-1]
+      token = cache.get(symbol)
+      if token is None:
+        token_str = symbol_table.strings[symbol]
+        token = cache[symbol] = Token(token_str, self.type_info(token_str, last=(i==n-1)))
+      tokens.append(token)
+    return tokens
+
   def const_satisfies_qualifier(self,const_token,cst):
-    'Return whether the tags that const_token has make it qualify for the condition_syntax_tree.Cst |cst|'
-    tags_in_qualifier_condition = cst.symbols()
-    tags_of_const_token = self.tags_of_const(const_token)
-    truth_mapping = {tag:(tag in tags_of_const_token)  for tag in tags_in_qualifier_condition}
-    return cst.evaluate(truth_mapping)
+    """ Return whether the tags that const_token has make it qualify for the condition_syntax_tree.Cst |cst|
+    Results are memoized in qualifier_cache, a bounded LRUCache; see qualifier_cache_info.
+    """
+    if self.qualifier_cache is None:
+      self.qualifier_cache = LRUCache(self.qualifier_cache_size)
+    key = (const_token.id, const_token.category, cst.condition_string)
+    result = self.qualifier_cache.get(key)
+    if result is MISSING:
+      result = cst.evaluate_mask(self.tag_mask_of_const(const_token))
+      self.qualifier_cache.put(key, result)
+    return result
+
+  def qualifier_cache_info(self):
+    'Return a dict of hit, miss and eviction counters of the qualifier cache'
+    if self.qualifier_cache is None:
+      self.qualifier_cache = LRUCache(self.qualifier_cache_size)
+    return self.qualifier_cache.info()
 
   def is_ingredient(self,name):
     'Return whether |name| is the name of an ingredient'
@@ -153,10 +287,12 @@ class ComponentRuleLHS:
   - o_dict: a dict mapping qualified 'o' variables to their qualifier condition_syntax_tree.Cst
   and unqualified 'o' variables to None
   - dont_match: possibly another ComponentRuleLHS representing a pattern to *not* match in order for this ComponentRuleLHS to match
+  - compiled: the most recent CompiledComponentRuleLHS built by compile, or None
   """
   def __init__(self, lhs_string):
     split = lhs_string.split()
 
+    self.compiled = None # see compile
     self.dont_match = None
     if "!!" in split:
       sep_idx = split.index("!!")
@@ -204,8 +340,49 @@ class ComponentRuleLHS:
   def __eq__(self,other):
     return self.component==other.component and self.strictness==other.strictness and self.o_dict==other.o_dict and self.dont_match==other.dont_match
 
+  def compile(self, type_checker):
+    """ Return a CompiledComponentRuleLHS of this pattern for |type_checker|.
+    The result is remembered, so it is only rebuilt when a different type checker is given.
+    """
+    if self.compiled is None or self.compiled.type_checker is not type_checker:
+      self.compiled = CompiledComponentRuleLHS(self, type_checker)
+    return self.compiled
 
 
+class CompiledComponentRuleLHS:
+  """ A ComponentRuleLHS prepared for matching with a particular TypeChecker.
+  Internal structure:
+  - lhs: the ComponentRuleLHS this was compiled from
+  - type_checker: the TypeChecker that was used to type the tokens
+  - tokens: list of Token, the typed pattern tokens (qualifiers already parsed)
+  - strictness, o_dict: as in ComponentRuleLHS
+  - dont_match: None or the CompiledComponentRuleLHS of lhs.dont_match
+  - generated_matcher: None, or a function taking target tokens and a type checker that does the
+    same as interpret_compiled_component_pattern. See parse_reductions.compile_rules.
+  """
+  def __init__(self, lhs, type_checker):
+    self.lhs = lhs
+    self.type_checker = type_checker
+    self.generated_matcher = None
+    self.tokens = parse_component_tokens(lhs.component, type_checker)
+    self.strictness = lhs.strictness
+    self.o_dict = lhs.o_dict
+    self.dont_match = None if lhs.dont_match is None else lhs.dont_match.compile(type_checker)
+
+  def __str__(self):
+    return str(self.lhs)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['generated_matcher'] = None # generated code is not pickled, see parse_reductions.compile_rules
+    return state
+
+
+
+def parse_component_tokens(component, type_checker):
+  'Return the list of Tokens making up the Component |component|, typed by |type_checker|'
+  n = len(component.tokens)
+  return [Token(token_str, type_checker.type_info(token_str, last=(i==n-1))) for i,token_str in enumerate(component.tokens)]
 
 
 def match_component_pattern(pattern, target, type_checker):
@@ -213,76 +390,84 @@ def match_component_pattern(pattern, target, type_checker):
   return a match dictionary mapping the m and i variables in |pattern|
   to various constants in |target|, and mapping the o variables in |pattern|
   to lists of constants from |target|. Return None if no match.
+  |pattern| may also be a CompiledComponentRuleLHS, in which case its own type checker was used to compile it.
   """
+  if not isinstance(pattern, CompiledComponentRuleLHS):
+    pattern = pattern.compile(type_checker)
+  return match_compiled_component_pattern(pattern, type_checker.parse_component(target), type_checker)
 
-  if pattern.dont_match is not None:
-    if match_component_pattern(pattern.dont_match, target, type_checker) is not None:
-      return None
 
-  parsed_pattern_tokens = []
-  for i,token_str in enumerate(pattern.component.tokens):
-    parsed_pattern_tokens.append(
-      Token(token_str, type_checker.type_info(token_str, last=(i==len(pattern.component.tokens)-1) ) )
-    )
-
-  parsed_target_tokens = []
-  for i,token_str in enumerate(target.tokens):
-    parsed_target_tokens.append(
-      Token(token_str, type_checker.type_info(token_str, last=(i==len(target.tokens)-1) ) )
-    )
-
-  return match_component_pattern_recurse(
-    parsed_pattern_tokens,
-    parsed_target_tokens,
-    type_checker,
-    pattern,
-    True,
-    {}
-  )
-
-
-def match_component_pattern_recurse(pattern_tokens,target_tokens,type_checker,original_lhs,search_beyond_head,partial_match):
+def match_compiled_component_pattern(compiled, target_tokens, type_checker):
+  """ Like match_component_pattern, but with a CompiledComponentRuleLHS |compiled|
+  and a target that has already been parsed into a list of Token.
+  Uses the generated matcher of |compiled| if it has one, and otherwise interprets the pattern.
   """
+  if compiled.generated_matcher is not None:
+    return compiled.generated_matcher(target_tokens, type_checker)
+  return interpret_compiled_component_pattern(compiled, target_tokens, type_checker)
+
+
+def interpret_compiled_component_pattern(compiled, target_tokens, type_checker):
+  'Like match_compiled_component_pattern, but always interpreting the pattern'
+  if compiled.dont_match is not None:
+    if match_compiled_component_pattern(compiled.dont_match, target_tokens, type_checker) is not None:
+      return None
+
+  used = [False]*len(target_tokens)
+  bindings = {}
+  if not match_component_pattern_recurse(compiled.tokens, target_tokens, type_checker, compiled.strictness, 0, 0, used, bindings):
+    return None
+
+  match = {name : tt.name for name,tt in bindings.items()}
+  add_to_o_assignment(match, [tt for tti,tt in enumerate(target_tokens) if not used[tti]], compiled.o_dict, type_checker)
+  return match
+
+
+def match_component_pattern_recurse(pattern_tokens,target_tokens,type_checker,strictness,pattern_index,start,used,bindings):
+  """ Search for a way to match pattern_tokens[pattern_index:] to the target tokens that are not used yet.
   pattern_tokens: list of Token
   target_tokens: list of Token
   type_checker: TypeChecker
-  original_lhs: ComponentRuleLHS
-  search_beyond_head: bool
-  partial_match: dict
+  strictness: the strictness setting of the pattern, '', '&' or '&&'
+  pattern_index: int, index of the pattern token to match next
+  start: int, one past the index of the last matched target token (only used in the strict settings)
+  used: list of bool marking the target tokens that are already matched
+  bindings: dict mapping the variables matched so far to target Tokens
+  Return True if a match is found, leaving |used| and |bindings| describing it.
+  Otherwise return False, leaving |used| and |bindings| as they were.
+  The search state is changed and undone in place, so nothing is copied when backtracking.
   """
+  if pattern_index==len(pattern_tokens):
+    return True
+
+  tp = pattern_tokens[pattern_index]
+  if not strictness:
+    candidates = range(len(target_tokens))
+  elif strictness=='&&' and pattern_index>0:
+    candidates = range(start, min(start+1,len(target_tokens))) # only the next token can match
+  else:
+    candidates = range(start, len(target_tokens))
+
+  is_var = tp.varness!='const'
+  for tti in candidates:
+    if used[tti]: continue
+    tt = target_tokens[tti]
+    if not tp.matches(tt,type_checker): continue
+    bound = bindings.get(tp.name) if is_var else None
+    if bound is not None and bound.id!=tt.id: continue
+    used[tti] = True
+    if is_var and bound is None:
+      bindings[tp.name] = tt
+    if match_component_pattern_recurse(pattern_tokens,target_tokens,type_checker,strictness,pattern_index+1,tti+1,used,bindings):
+      return True
+    used[tti] = False
+    if is_var and bound is None:
+      del bindings[tp.name]
+  return False
 
-  if len(pattern_tokens)==0:
-    final_match = copy.deepcopy(partial_match)
-    add_to_o_assignment(final_match, target_tokens, original_lhs.o_dict, type_checker)
-    return final_match
-
-  tp = pattern_tokens[0]
-  for tti,tt in enumerate(target_tokens):
-    if tp.matches(tt,type_checker):
-      if tp.name not in partial_match or partial_match[tp.name]==tt.name:
-        new_partial_match = partial_match
-        if tp.varness != 'const':
-          new_partial_match = copy.deepcopy(partial_match)
-          new_partial_match.update({tp.name : tt.name})
-        if original_lhs.strictness in ['&', '&&']:
-          new_target_tokens = target_tokens[tti+1:]
-          add_to_o_assignment(new_partial_match, target_tokens[:tti], original_lhs.o_dict, type_checker)
-        else:
-          new_target_tokens = copy.deepcopy(target_tokens)
-          new_target_tokens.pop(tti)
-        match = match_component_pattern_recurse(
-          pattern_tokens[1:],
-          new_target_tokens,
-          type_checker,
-          original_lhs,
-          original_lhs.strictness!='&&',
-          new_partial_match
-        )
-        if match is not None: return match
-    if not search_beyond_head: break
-  return None
 
 def add_to_o_assignment(match_dict, const_tokens, o_dict, type_checker):
+  'Add the names of the Tokens in |const_tokens|, which were left out of a match, to the o variables of |match_dict|'
   if not o_dict:
     match_dict['o_auto'] = match_dict.get('o_auto',[]) + [tt.name for tt in const_tokens]
   else:
@@ -291,19 +476,53 @@ def add_to_o_assignment(match_dict, const_tokens, o_dict, type_checker):
         [tt.name for tt in const_tokens if ovar_qualifier is None or type_checker.const_satisfies_qualifier(tt,ovar_qualifier)]
 
 
+class RuleProfile:
+  """ Counters of a reduction rule, kept while profiling is on; see ReductionSystem.enable_profiling
+  - attempts: calls of apply
+  - matches: attempts where the lhs matched
+  - rewrites: matches that changed something
+  - match_seconds, substitution_seconds: time spent matching the lhs, and building the result of a match
+  - iterations: applications of the rule in the fixed point loops of a ReductionSystem
+  """
+  fields = ['attempts', 'matches', 'rewrites', 'iterations', 'match_seconds', 'substitution_seconds']
+
+  def __init__(self):
+    self.attempts = self.matches = self.rewrites = self.iterations = 0
+    self.match_seconds = self.substitution_seconds = 0.0
+
+  def as_dict(self):
+    return {field : getattr(self,field) for field in self.fields}
+
+
+
 class ReductionRuleComponent:
   """ A ReductionRuleComponent represents a rule that converts things matching the lhs pattern to the form described by the rhs
       The rhs_str is a string representing a Component and the lhs_str is a string representing a ComponentRuleLHS.
       type_checker is a pattern_match.TypeChecker subclass
+      profile is None, or a RuleProfile that apply updates
   """
+  profile = None
+
   def __init__(self, lhs_str, rhs_str, type_checker=TrivialTypeChecker()):
     self.lhs = ComponentRuleLHS(lhs_str)
     self.rhs = Component(rhs_str)
-    self.type_checker = type_checker
+    self.set_type_checker(type_checker)
 
   def __str__(self):
     return str(self.lhs) + " -> " + str(self.rhs)
 
+  def set_type_checker(self, type_checker):
+    'Set the type checker, and compile the lhs and rhs patterns for it'
+    self.type_checker = type_checker
+    self.compiled_lhs = self.lhs.compile(type_checker)
+    self.rhs_tokens = parse_component_tokens(self.rhs, type_checker)
+    self.generated_builder = None # see parse_reductions.compile_rules
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['generated_builder'] = None
+    return state
+
   def match_lhs(self,component):
     """ Match the pattern of the lhs to the given Component, and return
     a dict representing the match. Return None if there is no match.
@@ -311,17 +530,37 @@ class ReductionRuleComponent:
     Returns the match, which is a dict whose keys are the variables in the lhs,
     and whose values are tokens or lists of tokens selected from component.
     """
-    return match_component_pattern(self.lhs,component,self.type_checker)
+    if self.compiled_lhs.type_checker is not self.type_checker:
+      self.set_type_checker(self.type_checker)
+    return match_component_pattern(self.compiled_lhs,component,self.type_checker)
 
   def apply(self,component,debug=False):
     """ Apply the reduction rule to the given Component
-        Returns a Component, the result of applying the rule to component
+        Returns a Component, the result of applying the rule to component.
+        This is |component| itself exactly when nothing was rewritten.
     """
+    profile = self.profile
+    if profile is not None:
+      start = time.perf_counter()
     match = self.match_lhs(component)
+    if profile is not None:
+      matched = time.perf_counter()
+      profile.attempts += 1
+      profile.match_seconds += matched-start
     if match is None:
       return component # No match, component is already reduced wrt this rule
 
-    out = apply_substitution_to_component(self.rhs, match, self.type_checker)
+    if self.generated_builder is not None:
+      out = Component(self.generated_builder(match))
+    else:
+      out = substitute_tokens(self.rhs_tokens, match)
+    if profile is not None:
+      profile.matches += 1
+      profile.substitution_seconds += time.perf_counter()-matched
+    if out == component:
+      return component # The rule rewrote the component to itself
+    if profile is not None:
+      profile.rewrites += 1
 
     if debug:
       print("\nRULE",self)
@@ -336,13 +575,11 @@ def apply_substitution_to_component(component, subst_dict, type_checker):
   """ Given a Component and given a subst_dict mapping variables
   in |tokens| to constants, return the component that results from carrying
   out all the substitutions. If subst_dict has an 'o_auto' then put that in no matter what."""
+  return substitute_tokens(parse_component_tokens(component, type_checker), subst_dict)
 
-  parsed_tokens = []
-  for i,token_str in enumerate(component.tokens):
-    parsed_tokens.append(
-      Token(token_str, type_checker.type_info(token_str, last=(i==len(component.tokens)-1) ) )
-    )
 
+def substitute_tokens(parsed_tokens, subst_dict):
+  'Like apply_substitution_to_component, but with the component already parsed into a list of Token'
   result_tokens = []
   if 'o_auto' in subst_dict:
     result_tokens += subst_dict['o_auto']
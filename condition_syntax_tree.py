@@ -76,12 +76,84 @@ def read_condition_string(condition_string):
   return root
 
 
+tag_bits = {} # maps each tag seen by tag_bit to its bit
+
+def tag_bit(tag):
+  'Return the bit standing for |tag| in tag masks, assigning a new one the first time a tag is seen'
+  bit = tag_bits.get(tag)
+  if bit is None:
+    bit = tag_bits[tag] = 1 << len(tag_bits)
+  return bit
+
+def tag_mask(tags):
+  'Return the tag mask with the bits of all the tags in |tags| set'
+  mask = 0
+  for tag in tags:
+    mask |= tag_bit(tag)
+  return mask
+
+
+def is_primitive(ast):
+  return ast.token not in ['&','|','!','.']
+
+def compile_ast(ast, condition_string):
+  """ Compile the Tree |ast| into a function that takes a tag mask (see tag_mask)
+  and returns the truth value of the condition when exactly the tags in the mask are true.
+  Conjunctions and disjunctions of (possibly negated) primitives become a couple of integer operations.
+  """
+  if is_primitive(ast):
+    if ast.children:
+      raise Exception("Malformed conditional expression: "+condition_string)
+    bit = tag_bit(ast.token)
+    return lambda mask : (mask & bit) != 0
+
+  if ast.token in ['.','!'] and len(ast.children)!=1:
+    raise Exception("Malformed conditional expression: "+condition_string)
+
+  if ast.token=='.':
+    return compile_ast(ast.children[0], condition_string)
+
+  if ast.token=='!':
+    child = ast.children[0]
+    while child.token=='.' and len(child.children)==1:
+      child = child.children[0]
+    if is_primitive(child) and not child.children:
+      bit = tag_bit(child.token)
+      return lambda mask : (mask & bit) == 0
+    f = compile_ast(child, condition_string)
+    return lambda mask : not f(mask)
+
+  # ast.token is '&' or '|'. Fold primitive and negated primitive children into two masks.
+  positive, negative, others = 0, 0, []
+  for child in ast.children:
+    while child.token=='.' and len(child.children)==1:
+      child = child.children[0]
+    if is_primitive(child) and not child.children:
+      positive |= tag_bit(child.token)
+    elif child.token=='!' and len(child.children)==1 and is_primitive(child.children[0]) and not child.children[0].children:
+      negative |= tag_bit(child.children[0].token)
+    else:
+      others.append(compile_ast(child, condition_string))
+
+  if ast.token=='&':
+    if not others:
+      return lambda mask : (mask & positive) == positive and (mask & negative) == 0
+    return lambda mask : (mask & positive) == positive and (mask & negative) == 0 and all(f(mask) for f in others)
+  else:
+    if not others:
+      return lambda mask : (mask & positive) != 0 or (mask & negative) != negative
+    return lambda mask : (mask & positive) != 0 or (mask & negative) != negative or any(f(mask) for f in others)
+
+
 class Cst:
   """ Condition syntax tree class. See read_condition_string
   docstring for condition_string syntax.
 
   This class wraps a Tree which is a parsed abstract syntax tree.
   It provides methods for applying semantics.
+  On construction the tree is also compiled (see compile_ast) into the function
+  evaluate_mask, which takes a tag mask and returns the truth value of the condition
+  when exactly the tags in the mask are true.
 
   Raises exception on parse error.
   """
@@ -91,45 +163,62 @@ class Cst:
       self.ast = read_condition_string(condition_string) # abstract syntax tree
     except:
       raise Exception("Unable to parse condition string: "+str(condition_string))
+    self.evaluate_mask = compile_ast(self.ast, condition_string)
+    self.symbol_list = self.symbols_of_ast(self.ast)
+
+  def __getstate__(self):
+    # evaluate_mask is a closure over tag bits that are specific to this process, so it is compiled again on unpickling
+    state = self.__dict__.copy()
+    del state['evaluate_mask']
+    return state
 
-  def evaluate(self,truth_mapping,ast=None):
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.evaluate_mask = compile_ast(self.ast, self.condition_string)
+
+  def evaluate(self,truth_mapping):
     """ |truth_mapping| is a dict from primitive symbols in the condition string
     to bool values. This will evaluate the condition string, treating the tokens
     &, |, and ! as the usual "and," "or," and "not"
-    |ast| is used for recursion and should be ignored for normal usage.
     """
-    if ast is None:
-      ast = self.ast
-
-    truth_vals_of_children = [self.evaluate(truth_mapping,c) for c in ast.children]
+    for symbol in self.symbol_list:
+      if symbol not in truth_mapping:
+        raise KeyError(symbol)
+    return self.evaluate_mask(tag_mask(symbol for symbol,value in truth_mapping.items() if value))
 
-    if ast.token=='&':
-      return all(truth_vals_of_children)
-    if ast.token=='|':
-      return any(truth_vals_of_children)
-    if ast.token=='!':
-      if not len(truth_vals_of_children)==1:
-        raise Exception("Malformed conditional expression: "+self.condition_string)
-      return not truth_vals_of_children[0]
-    if ast.token=='.':
-      if not len(truth_vals_of_children)==1:
-        raise Exception("Malformed conditional expression: "+self.condition_string)
-      return truth_vals_of_children[0]
-    else:
-      assert(len(truth_vals_of_children)==0)
-      return truth_mapping[ast.token]
-
-  def symbols(self,ast=None):
+  def symbols(self):
     """ Return a list of the primitive symbols in the condition string.
+    """
+    return list(self.symbol_list)
+
+  def required_symbols(self, ast=None):
+    """ Return a set of primitive symbols that must all be true for the condition to be true.
+    This is not always the smallest such set, but every symbol in it is really required.
     |ast| is used for recursion and should be ignored for normal usage.
     """
     if ast is None:
       ast = self.ast
-    symbols_of_children = sum([self.symbols(c) for c in ast.children],[])
-    if ast.token not in ['&','|','!','.']:
-      return [ast.token]+symbols_of_children
-    else:
-      return symbols_of_children
+    if is_primitive(ast):
+      return {ast.token}
+    if ast.token=='.':
+      return self.required_symbols(ast.children[0])
+    if ast.token=='&':
+      return set().union(*(self.required_symbols(c) for c in ast.children))
+    if ast.token=='|':
+      return set.intersection(*(self.required_symbols(c) for c in ast.children))
+    return set() # ast.token=='!'
+
+  @staticmethod
+  def symbols_of_ast(ast):
+    'Return the list of primitive symbols in the Tree |ast|, in the order they appear'
+    symbols = []
+    stack = [ast]
+    while stack:
+      node = stack.pop()
+      if is_primitive(node):
+        symbols.append(node.token)
+      stack.extend(reversed(node.children))
+    return symbols
 
 
   def __eq__(self,other):
@@ -1,4 +1,6 @@
-import sys, cmd, parse_reductions, parse_ingredients
+import sys, cmd, json, time, tracemalloc, parse_reductions, parse_ingredients, condition_syntax_tree, closure_table
+from functools import cached_property
+from cache import CACHE_DIR
 from util import *
 from mixture import *
 from component import *
@@ -6,74 +8,231 @@ from component import *
 
 # Define the type checker
 class InteractiveTypeChecker(TypeChecker):
+  """ The ingredients and modifier tags are fixed once loaded, so the tags of every constant
+  are computed up front as frozen sets and tag masks.
+  """
   def __init__(self, ingredients_byname,modifier_tags):
     self.ingredients_byname = ingredients_byname
     self.modifier_tags = modifier_tags
+    self.ingredient_tags = {}
+    for name,ing in ingredients_byname.items():
+      # all ingredients have magic "Ingredient" tag and their own name, and ingredients can also take on modifier tags
+      self.ingredient_tags[name] = frozenset(['Ingredient', name] + ing.inherited_from + modifier_tags.get(name,[]))
+    self.modifier_tag_sets = {mod : frozenset(tags) for mod,tags in modifier_tags.items()}
+    self.ingredient_masks = {name : condition_syntax_tree.tag_mask(tags) for name,tags in self.ingredient_tags.items()}
+    self.modifier_masks = {mod : condition_syntax_tree.tag_mask(tags) for mod,tags in self.modifier_tag_sets.items()}
+
+  def __getstate__(self):
+    # the masks depend on the tag bits of this process, so they are computed again on unpickling
+    return {'ingredients_byname' : self.ingredients_byname, 'modifier_tags' : self.modifier_tags}
+
+  def __setstate__(self, state):
+    self.__init__(state['ingredients_byname'], state['modifier_tags'])
 
   def tags_of_const(self, const_token):
     if const_token.category in ['ing','ingmod']:
-      out = ['Ingredient', const_token.name] # all ingredients have magic "Ingredient" tag and their own name
-      out += ingredients_byname[const_token.name].inherited_from
-      out += modifier_tags.get(const_token.name,[]) # ingredients can also take on modifier tags
-      return out
+      return self.ingredient_tags[const_token.name]
     if const_token.category == 'mod':
-      return modifier_tags.get(const_token.name,[])
-  def is_ingredient(self,name):
-    return name in ingredients_byname.keys()
-
-
-# Load ingredients
-ingredients = parse_ingredients.parse('ingredient_data')
-ingredients_byname = {}
-for ing in ingredients:
-  ingredients_byname[ing.name] = ing
+      return self.modifier_tag_sets.get(const_token.name,frozenset())
 
-# Restrict set of "gettable" ingredients
-# (In a game, this would be what can be harvested from preingredients in the world)
-excluded_ingdts = [
-  'Soup','Dough','Batter','Ash','Slurry','Caramel','Oatmeal'
+  def tag_mask_of_const(self, const_token):
+    if const_token.category in ['ing','ingmod']:
+      return self.ingredient_masks[const_token.name]
+    return self.modifier_masks.get(const_token.name,0)
+  def is_ingredient(self,name):
+    return name in self.ingredients_byname
+
+
+class Kitchen:
+  """ The ingredient catalog, reduction rules, type checker and reduction systems that the game runs on.
+  Each of these is loaded from the data files on first use, so constructing a Kitchen does no work,
+  and something that needs only the catalog never parses the rules.
+  The data files can be changed from the defaults to load an alternate kitchen.
+  load_stats maps the name of each part that has been loaded to the seconds it took, and to the bytes
+  it allocated if tracemalloc is tracing (e.g. python -X tracemalloc). Parts that need other parts
+  include the cost of loading those.
+  If |rule_analysis| is 'warn', rules that can never change anything (see parse_reductions.RuleAnalyzer)
+  are warned about when a reduction system is built, and if it is 'drop' they are also left out of it.
+  """
+  def __init__(self, ingredients_dir='ingredient_data', reductions_path='reductions',
+      reductions_display_path='reductions_display', cache_dir=CACHE_DIR, rule_analysis=None):
+    self.ingredients_dir = ingredients_dir
+    self.reductions_path = reductions_path
+    self.reductions_display_path = reductions_display_path
+    self.cache_dir = cache_dir
+    self.rule_analysis = rule_analysis
+    self.load_stats = {}
+    self.reduction_table = None # Optional precomputed reductions, see closure_table.py
+
+  def timed(self, part, load):
+    'Return load(), recording its cost in load_stats under |part|'
+    tracing = tracemalloc.is_tracing()
+    allocated_before = tracemalloc.get_traced_memory()[0] if tracing else None
+    start = time.perf_counter()
+    result = load()
+    self.load_stats[part] = {
+      'seconds' : time.perf_counter()-start,
+      'allocated_bytes' : tracemalloc.get_traced_memory()[0]-allocated_before if tracing else None,
+    }
+    return result
+
+  @cached_property
+  def ingredients(self):
+    return self.timed('ingredients', lambda : parse_ingredients.parse(self.ingredients_dir, self.cache_dir))
+
+  @cached_property
+  def ingredients_byname(self):
+    return {ing.name : ing for ing in self.ingredients}
+
+  @cached_property
+  def excluded_ingdts(self):
+    # Restrict set of "gettable" ingredients
+    # (In a game, this would be what can be harvested from preingredients in the world)
+    excluded_ingdts = [
+      'Soup','Dough','Batter','Ash','Slurry','Caramel','Oatmeal'
+    ]
+    excluded_ingdts += [i_name for i_name,i in self.ingredients_byname.items() if "CookedSolid" in i.inherited_from]
+    return excluded_ingdts
+
+  @cached_property
+  def gettable_ingredients(self):
+    return [i_name for i_name in self.ingredients_byname if i_name not in self.excluded_ingdts]
+
+  @cached_property
+  def parsed_reductions(self):
+    return self.timed('reductions', lambda : parse_reductions.parse(self.reductions_path, self.cache_dir))
+
+  @cached_property
+  def parsed_reductions_display(self):
+    return self.timed('reductions_display', lambda : parse_reductions.parse(self.reductions_display_path, self.cache_dir))
+
+  @property
+  def reduction_rules(self):
+    return self.parsed_reductions[0]
+
+  @property
+  def reduction_rules_display(self):
+    return self.parsed_reductions_display[0]
+
+  @cached_property
+  def modifier_tags(self):
+    modifier_tags = dict(self.parsed_reductions[1])
+    modifier_tags.update(self.parsed_reductions_display[1])
+    return modifier_tags
+
+  @cached_property
+  def type_checker(self):
+    return self.timed('type_checker', lambda : InteractiveTypeChecker(self.ingredients_byname, self.modifier_tags))
+
+  @cached_property
+  def rs(self):
+    return self.timed('rs', lambda : self.reduction_system(self.reduction_rules))
+
+  @cached_property
+  def rs_display(self):
+    return self.timed('rs_display', lambda : self.reduction_system(self.reduction_rules_display))
+
+  def reduction_system(self, rules):
+    rs = ReductionSystem(rules)
+    rs.set_type_checker(self.type_checker)
+    if self.rule_analysis is not None:
+      findings = parse_reductions.analyze_rules(rs.rules, self.type_checker, self.ingredients_byname, self.modifier_tags)
+      if self.rule_analysis=='drop':
+        useless = set(id(rule) for rule,_ in findings)
+        rs.rules = [rule for rule in rs.rules if id(rule) not in useless]
+    return rs
+
+  def token_str_has_tag(self, token_str, tag):
+    return self.type_checker.const_has_tag(self.type_checker.parse_token(token_str) , tag)
+
+  def load_reduction_table(self, path):
+    'Use the closure table at |path| for reductions, unless it is missing or out of date'
+    try:
+      self.reduction_table = closure_table.ClosureTable(path, closure_table.kitchen_fingerprint(self))
+    except Exception as e:
+      print("Warning: not using closure table: {}".format(e), file=sys.stderr)
+      self.reduction_table = None
+
+  def reduce_mixture(self, display, mixture):
+    'Reduce |mixture| with rs, or rs_display if |display|, looking it up in the reduction table first'
+    if self.reduction_table is not None:
+      reduced = self.reduction_table.lookup('D' if display else 'R', mixture)
+      if reduced is not None:
+        return reduced
+    return (self.rs_display if display else self.rs).reduce_mixture(mixture)
+
+
+_default_kitchen = None
+
+def default_kitchen():
+  'Return the Kitchen with the default data files, creating it on first use'
+  global _default_kitchen
+  if _default_kitchen is None:
+    _default_kitchen = Kitchen()
+  return _default_kitchen
+
+# Names that used to be module globals, and are now looked up in the default kitchen
+kitchen_globals = [
+  'ingredients', 'ingredients_byname', 'excluded_ingdts', 'gettable_ingredients',
+  'reduction_rules', 'reduction_rules_display', 'modifier_tags',
+  'type_checker', 'rs', 'rs_display', 'token_str_has_tag',
 ]
-excluded_ingdts += [i_name for i_name,i in ingredients_byname.items() if "CookedSolid" in i.inherited_from]
-gettable_ingredients = [i_name for i_name in ingredients_byname if i_name not in excluded_ingdts]
-
-# Load reduction rules
-reduction_rules, modifier_tags = parse_reductions.parse('reductions')
-reduction_rules_display, modifier_tags_display = parse_reductions.parse('reductions_display')
-modifier_tags.update(modifier_tags_display)
 
-# Create type checker
-type_checker = InteractiveTypeChecker(ingredients_byname, modifier_tags)
-
-def token_str_has_tag(token_str, tag):
-  return type_checker.const_has_tag(type_checker.parse_token(token_str) , tag)
-
-# Create reduction system
-rs = ReductionSystem(reduction_rules)
-rs_display = ReductionSystem(reduction_rules_display)
-rs.set_type_checker(type_checker)
-rs_display.set_type_checker(type_checker)
+def __getattr__(name):
+  if name in kitchen_globals:
+    return getattr(default_kitchen(), name)
+  raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Food:
-  def __init__(self,mixture=Mixture(),in_container=True):
+  def __init__(self,mixture=Mixture(),in_container=True,kitchen=None):
+    self.kitchen = kitchen if kitchen is not None else default_kitchen()
     self.mixture = mixture
     self.in_container = in_container
     self.marked_for_deletion = False
     self.marked_for_separating_out = []
 
   def reduce(self):
-    self.mixture = rs.reduce_mixture(self.mixture)
+    self.mixture = self.kitchen.reduce_mixture(False, self.mixture)
+
+  # Mixtures and Components can be shared with reduction results and caches, so they are never
+  # changed in place here; changes build new ones instead.
 
   def mix_in(self, other):
     self.in_container = self.in_container or other.in_container
-    self.mixture.components += other.mixture.components
+    self.mixture = Mixture(self.mixture.components + other.mixture.components)
     self.reduce()
 
+  def component_index(self, component):
+    """ Return the position of the very object |component| in the mixture, or None if it is not there.
+    Components are immutable and equal ones can appear more than once, so foods look them up by identity.
+    """
+    return next((i for i,c in enumerate(self.mixture.components) if c is component), None)
+
   def remove_component(self,component):
-    self.mixture.components.remove(component)
+    i = self.component_index(component)
+    if i is None:
+      raise Exception("Cannot remove {}, which is no longer in the mixture {}".format(component, self.mixture))
+    self.mixture = Mixture(self.mixture.components[:i] + self.mixture.components[i+1:])
     if not self.mixture.components:
       self.marked_for_deletion = True
 
+  def replace_component(self, component, new_component):
+    """ Replace the very object |component| by |new_component|, and return |new_component|.
+    A component that was separated out is replaced among those marked for separating out.
+    """
+    i = self.component_index(component)
+    if i is not None:
+      components = list(self.mixture.components)
+      components[i] = new_component
+      self.mixture = Mixture(components)
+      return new_component
+    for i,c in enumerate(self.marked_for_separating_out):
+      if c is component:
+        self.marked_for_separating_out[i] = new_component
+        return new_component
+    raise Exception("Cannot change {}, which is no longer in the mixture {}".format(component, self.mixture))
+
   def apply_action_from_attribute(self,attribute):
     for component in self.mixture.components[:]:
       self.apply_action_to_component(component, attribute)
@@ -81,7 +240,7 @@ class Food:
   
   def bake_but_fry_fatties(self):
     for component in self.mixture.components[:]:
-      if any(token_str_has_tag(token_str,"Fat") for token_str in component.tokens):
+      if any(self.kitchen.token_str_has_tag(token_str,"Fat") for token_str in component.tokens):
         self.apply_action_to_component(component, "cook_fry")
       else:
         self.apply_action_to_component(component, "cook_bake")
@@ -90,13 +249,13 @@ class Food:
   def apply_action_to_component(self, component, attribute):
     # extract base ingredient from component, asserting that it's a const
     ing_name = component.tokens[-1]
-    ing_varness, _ = type_checker.type_info(ing_name, last=True)
+    ing_varness, _ = self.kitchen.type_checker.type_info(ing_name, last=True)
     if ing_varness != 'const':
       raise Exception("It does not make sense to apply actions to component expressions with variables: "+str(component))
     # lookup in parsed ingredients and find that ingredient's "attribute" attribute (e.g. "slice")
-    if ing_name not in ingredients_byname:
+    if ing_name not in self.kitchen.ingredients_byname:
       raise Exception("Ingredient does not exist: "+ing_name)
-    ing = ingredients_byname[ing_name]
+    ing = self.kitchen.ingredients_byname[ing_name]
     if attribute not in ing.__dict__:
       raise Exception("Ingredient {} is missing attribute {}.".format(ing_name,attribute))
     actions_string = ing.__dict__[attribute]
@@ -111,12 +270,12 @@ class Food:
         if len(args)!=2:
           print("Invalid arguments in action:",action)
         else:
-          component.tokens.insert(0,args[1])
+          component = self.replace_component(component, Component([args[1]] + component.tokens))
       elif args[0]=='lose_mod':
         if len(args)!=2:
           print("Invalid arguments in action:",action)
         else:
-          component.tokens = list(filter(lambda t:t!=args[1] , component.tokens))
+          component = self.replace_component(component, Component(list(filter(lambda t:t!=args[1] , component.tokens))))
       elif args[0]=='delete':
         if len(args)!=1:
           print("Invalid arguments in action:",action)
@@ -128,10 +287,10 @@ class Food:
         else:
           new_component_tokens = [t if t!='SELF' else ing_name for t in args[1:]]
           new_ing_name = new_component_tokens[-1]
-          if new_ing_name not in ingredients_byname:
+          if new_ing_name not in self.kitchen.ingredients_byname:
             print("Warning: a 'yield' action from {} has produced an ingredient {} that does not exist.\
               This is probably bad.".format(ing_name,new_ing_name))
-          self.mixture.components.append(Component(new_component_tokens))
+          self.mixture = Mixture(self.mixture.components + [Component(new_component_tokens)])
       elif args[0]=='separate_out':
         if len(args)!=1:
           print("Invalid arguments in action:",action)
@@ -143,11 +302,10 @@ class Food:
           print("Invalid arguments in action:",action)
         else:
           new_ing_name = args[-1]
-          if new_ing_name not in ingredients_byname:
+          if new_ing_name not in self.kitchen.ingredients_byname:
             print("Warning: a 'become' action from {} has produced an ingredient {} that does not exist.\
               This is probably bad.".format(ing_name,new_ing_name))
-          component.tokens.pop()
-          component.tokens += args[1:]
+          component = self.replace_component(component, Component(component.tokens[:-1] + args[1:]))
       else:
         print("Didn't know what to do with this action: "+action)
 
@@ -159,9 +317,9 @@ class Food:
     # They, or anything that inherits from them, will be treated specially for cook
     if not self.in_container:
       self.apply_action_from_attribute("cook_flame")
-    elif any(token_str_has_tag(component.tokens[-1],"Water") for component in self.mixture.components):
+    elif any(self.kitchen.token_str_has_tag(component.tokens[-1],"Water") for component in self.mixture.components):
       self.apply_action_from_attribute("cook_boil")
-    elif any(token_str_has_tag(component.tokens[-1],"Fat") for component in self.mixture.components):
+    elif any(self.kitchen.token_str_has_tag(component.tokens[-1],"Fat") for component in self.mixture.components):
       self.apply_action_from_attribute("cook_fry")
     else:
       self.bake_but_fry_fatties()
@@ -170,7 +328,7 @@ class Food:
     pot_str = "Pot containing " if self.in_container else ""
     mixture_display = self.mixture
     if reduce_for_display:
-      mixture_display = rs_display.reduce_mixture(mixture_display)
+      mixture_display = self.kitchen.reduce_mixture(True, mixture_display)
     return pot_str+str(mixture_display)
 
 
@@ -180,11 +338,15 @@ class IngredientsCmd(cmd.Cmd):
   prompt = 'ingdts> '
   file = None
 
+  def __init__(self, kitchen=None, **kwargs):
+    super().__init__(**kwargs)
+    self.kitchen = kitchen if kitchen is not None else default_kitchen()
+
   def preloop(self):
     self.foods = []
     self.prompt_index = 0
     if '-d' in sys.argv:
-      rs.toggle_debug()
+      self.kitchen.rs.toggle_debug()
       self.do_record('a')
 
   def do_cut(self, arg):
@@ -209,14 +371,14 @@ class IngredientsCmd(cmd.Cmd):
 
   def do_get(self, arg):
     'Grab an ingredient : get Onion'
-    if arg not in gettable_ingredients:
-      possible_matches = [k for k in gettable_ingredients if k.lower()==arg.lower()]
+    if arg not in self.kitchen.gettable_ingredients:
+      possible_matches = [k for k in self.kitchen.gettable_ingredients if k.lower()==arg.lower()]
       if possible_matches:
         arg = possible_matches[0]
       else:
-        print("Not an ingredient. Possible ingredients: "+', '.join(gettable_ingredients))
+        print("Not an ingredient. Possible ingredients: "+', '.join(self.kitchen.gettable_ingredients))
         return
-    self.foods.append(Food(Mixture(arg)))
+    self.foods.append(Food(Mixture(arg),kitchen=self.kitchen))
 
   def do_dump(self, arg):
     'Dump out a food item from the list: dump 2'
@@ -224,7 +386,7 @@ class IngredientsCmd(cmd.Cmd):
     self.foods.pop(int(arg))
 
   def help_get(self):
-    print('Grab an ingredient : get Onion\nPossible ingredients: '+', '.join(gettable_ingredients))
+    print('Grab an ingredient : get Onion\nPossible ingredients: '+', '.join(self.kitchen.gettable_ingredients))
 
   def do_mix(self,arg):
     'Mix foods of the indicated indices in the list: mix 2 3 5'
@@ -257,9 +419,31 @@ class IngredientsCmd(cmd.Cmd):
 
   def do_debug(self, arg):
     'Toggle debugging (off by deault): debug'
-    rs.toggle_debug()
-    print('Debugging turned','on' if rs.debug else 'off')
-    # rs_display.toggle_debug()
+    self.kitchen.rs.toggle_debug()
+    print('Debugging turned','on' if self.kitchen.rs.debug else 'off')
+    # self.kitchen.rs_display.toggle_debug()
+
+  def do_profile(self, arg):
+    'Profile the reduction rules: profile on | off | reset | show [number of rules] | json filename'
+    args = arg.split()
+    rs = self.kitchen.rs
+    if args==['on']:
+      rs.enable_profiling()
+    elif args==['off']:
+      rs.disable_profiling()
+    elif args==['reset']:
+      rs.reset_profiling()
+    elif args and args[0]=='show' and len(args)<=2 and all(a.isnumeric() for a in args[1:]):
+      if not rs.profiling:
+        print("Profiling is off. Turn it on with: profile on")
+      print(rs.profile_report(int(args[1]) if len(args)==2 else None))
+    elif len(args)==2 and args[0]=='json':
+      with open(args[1],'w') as f:
+        json.dump(rs.profile_data(), f, indent=1)
+    else:
+      print("Error: usage is profile on | off | reset | show [number of rules] | json filename")
+      return
+    print('Profiling is','on' if rs.profiling else 'off')
 
   def do_EOF(self, arg):
     'Quit (press ctrl+D)'
@@ -281,15 +465,19 @@ class IngredientsCmd(cmd.Cmd):
       print("\t{}: {}".format(i,food.__str__(reduce_for_display)))
     print()
 
+  def tidy_foods(self):
+    'Remove foods marked for deletion, and make foods of what was marked for separating out'
+    for food in self.foods:
+      if food.marked_for_deletion:
+        self.foods.remove(food)
+      if food.marked_for_separating_out:
+        self.foods.append(Food(Mixture(food.marked_for_separating_out),kitchen=self.kitchen))
+        food.marked_for_separating_out = []
+
   def postcmd(self,stop,line):
     if not stop:
-      for food in self.foods:
-        if food.marked_for_deletion:
-          self.foods.remove(food)
-        if food.marked_for_separating_out:
-          self.foods.append(Food(Mixture(food.marked_for_separating_out)))
-          food.marked_for_separating_out = []
-      if all(c not in line for c in ['showreal','debug']):
+      self.tidy_foods()
+      if all(c not in line for c in ['showreal','debug','profile']):
         if self.file:
           print("\n\t[{}]: {}".format(self.prompt_index, line))
         self.report_foods()
@@ -305,7 +493,7 @@ class IngredientsCmd(cmd.Cmd):
       partial_arg = split_line[1]
     if len(partial_arg)>0:
       partial_arg = partial_arg[0].upper() + partial_arg[1:]
-    return [ing for ing in gettable_ingredients if partial_arg in ing]
+    return [ing for ing in self.kitchen.gettable_ingredients if partial_arg in ing]
 
 
     # ----- record and playback ----- (Copied from the example in the docs)
@@ -329,4 +517,13 @@ class IngredientsCmd(cmd.Cmd):
 
 
 if __name__ == '__main__':
-    IngredientsCmd().cmdloop()
+    kitchen = default_kitchen()
+    if '--check-rules' in sys.argv:
+      kitchen.rule_analysis = 'warn'
+    if '--drop-useless-rules' in sys.argv:
+      kitchen.rule_analysis = 'drop'
+    if '--closure-table' in sys.argv:
+      kitchen.load_reduction_table(sys.argv[sys.argv.index('--closure-table')+1])
+    if '--compile-rules' in sys.argv or '--verify-compiled-rules' in sys.argv:
+      parse_reductions.compile_rules(kitchen.rs.rules, verify='--verify-compiled-rules' in sys.argv)
+    IngredientsCmd(kitchen).cmdloop()
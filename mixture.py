@@ -1,5 +1,6 @@
-import copy
+import copy, time
 from component import *
+from cache import LRUCache, MISSING
 
 
 class Mixture:
@@ -9,6 +10,8 @@ class Mixture:
   (string-represented) components
   - a list of Components
   - another Mixture (in which case a copy is created)
+  A mixture hashes its list of components, so once it has been hashed or handed to a ReductionSystem
+  it must not be mutated; build a new Mixture instead.
   """
   def __init__(self,init=None):
     if init is None:
@@ -28,6 +31,18 @@ class Mixture:
   def __eq__(self,other):
     return self.components==other.components
 
+  def __hash__(self):
+    return hash(self.key())
+
+  def key(self):
+    'Return a hashable canonical form of this Mixture: the tuple of the keys of its components'
+    return tuple(c.ids for c in self.components)
+
+  @classmethod
+  def from_key(cls, key):
+    'Create a new Mixture from the result of key()'
+    return cls([Component.from_ids(ids) for ids in key])
+
 
 
 class MixtureRuleLHS:
@@ -48,11 +63,17 @@ class ReductionRuleMixture:
   """ A ReductionRuleMixture represents a rule that combines "reactants" on the lhs and turns them into the "products" on the rhs.
       The lhs_str is a string representing a MixtureRuleLHS and the rhs_str is a string representing a Mixture.
       type_checker is a subclass of TypeChecker
+      For each component pattern of the lhs there is a match memo, an LRUCache from component ids
+      to the match of that pattern against the component (or None). Matching a mixture then only runs
+      the component matcher on components that are new or were rewritten since they were last seen.
   """
+  match_memo_size = 4096
+  profile = None # or a RuleProfile, see ReductionRuleComponent
+
   def __init__(self,lhs_str,rhs_str, type_checker=TrivialTypeChecker()):
     self.lhs = MixtureRuleLHS(lhs_str)
     self.rhs = Mixture(rhs_str)
-    self.type_checker = type_checker
+    self.set_type_checker(type_checker)
 
   def __str__(self):
     return str(self.lhs) + " -> " + str(self.rhs)
@@ -61,19 +82,39 @@ class ReductionRuleMixture:
     """ Match the lhs pattern to the given Mixture.
         Return None or a pair as described in match_mixture_pattern
     """
-    return match_mixture_pattern(self.lhs.components,mixture.components,self.type_checker)
+    if self.compiled_lhs[0].type_checker is not self.type_checker:
+      self.set_type_checker(self.type_checker)
+    return match_mixture_pattern(self.compiled_lhs,mixture.components,self.type_checker,self.match_memos)
 
   def apply(self,mixture,debug=False):
     """ Apply the reduction rule to the given Mixture
-        Return the resulting Mixture
+        Return the resulting Mixture, which is |mixture| itself if nothing was rewritten
     """
+    profile = self.profile
+    if profile is not None:
+      start = time.perf_counter()
     match_result = self.match_lhs(mixture)
+    if profile is not None:
+      matched = time.perf_counter()
+      profile.attempts += 1
+      profile.match_seconds += matched-start
 
     if match_result is None:
       return mixture # No match, mixture is already reduced wrt this rule
 
     match_dict, remaining_components = match_result
-    out = Mixture([apply_substitution_to_component(c, match_dict,self.type_checker) for c in self.rhs.components] + remaining_components)
+    if self.generated_builders is not None:
+      products = [Component(build(match_dict)) for build in self.generated_builders]
+    else:
+      products = [substitute_tokens(tokens, match_dict) for tokens in self.rhs_tokens]
+    out = Mixture(products + remaining_components)
+    if profile is not None:
+      profile.matches += 1
+      profile.substitution_seconds += time.perf_counter()-matched
+    if out == mixture:
+      return mixture # The rule rewrote the mixture to itself
+    if profile is not None:
+      profile.rewrites += 1
 
     if debug:
       print("\nRULE",self)
@@ -83,7 +124,27 @@ class ReductionRuleMixture:
     return out
 
   def set_type_checker(self,type_checker):
+    'Set the type checker, and compile the lhs and rhs patterns for it'
     self.type_checker = type_checker
+    self.compiled_lhs = [c.compile(type_checker) for c in self.lhs.components]
+    self.rhs_tokens = [parse_component_tokens(c, type_checker) for c in self.rhs.components]
+    self.generated_builders = None # see parse_reductions.compile_rules
+    self.match_memos = [LRUCache(self.match_memo_size) for _ in self.compiled_lhs] # matches depend on the type checker
+
+  def __getstate__(self):
+    # match memos are keyed on component ids, which are specific to this process
+    state = self.__dict__.copy()
+    state['generated_builders'] = None
+    del state['match_memos']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.match_memos = [LRUCache(self.match_memo_size) for _ in self.compiled_lhs]
+
+  def match_memo_info(self):
+    'Return a list with the counters of the match memo of each component pattern'
+    return [memory.info() for memory in self.match_memos]
 
 
 class ReductionRuleComponentAsMixture:
@@ -92,41 +153,114 @@ class ReductionRuleComponentAsMixture:
     self.component_rule = component_rule
 
   def apply(self,mixture,debug=False):
-    return Mixture([self.component_rule.apply(c,debug) for c in mixture.components])
+    'Apply the component rule to each component. Return |mixture| itself if no component was rewritten'
+    return mixture_with_components(mixture, [self.component_rule.apply(c,debug) for c in mixture.components])
 
   def set_type_checker(self, type_checker):
-    self.component_rule.type_checker = type_checker
+    self.component_rule.set_type_checker(type_checker)
+
+  @property
+  def profile(self):
+    return self.component_rule.profile
+
+  @profile.setter
+  def profile(self, profile):
+    self.component_rule.profile = profile
 
   def __str__(self):
     return str(self.component_rule)
 
 
-def match_mixture_pattern(pattern_components,components,type_checker,partial_match={}):
+def mixture_with_components(mixture, components):
+  """ Return a Mixture of the list |components|, which came from rewriting the components of |mixture| one by one.
+  If every component is the very same object as before then nothing was rewritten, and |mixture| itself is returned.
   """
-  pattern_components is a list of ComponentRuleLHS, probably consisting of some variables
+  if len(components)==len(mixture.components) and all(new is old for new,old in zip(components,mixture.components)):
+    return mixture
+  return Mixture(components)
+
+
+def match_component_pattern_memoized(pattern, component, type_checker, memory):
+  """ Return match_component_pattern(pattern, component, type_checker), looking it up
+  in the LRUCache |memory| by component ids first. |memory| can be None to not memoize.
+  The returned match can be shared with other callers, so it must not be modified.
+  """
+  if memory is None:
+    return match_component_pattern(pattern, component, type_checker)
+  match = memory.get(component.ids)
+  if match is MISSING:
+    match = match_component_pattern(pattern, component, type_checker)
+    memory.put(component.ids, match)
+  return match
+
+
+def join_key(match, variables):
+  'Return a hashable key made of the values in the dict |match| of the listed |variables|'
+  return tuple(tuple(match[v]) if isinstance(match[v],list) else match[v] for v in variables)
+
+
+def match_mixture_pattern(pattern_components,components,type_checker,match_memos=None):
+  """
+  pattern_components is a list of ComponentRuleLHS or CompiledComponentRuleLHS, probably consisting of some variables
   components is a list of Components, probably consisnting of only constants
   type_checker is a TypeChecker
-  partial_match helps with recursion, ignore for normal usage
+  match_memos is None or a list with an LRUCache for each pattern component, see match_component_pattern_memoized
   Returns None if there is no match. If there is a match then it returns a pair consisting of:
   (1) a dict mapping modifier and ingredient variables to the constants showing up in components
   (2) a list of components that were not involved in the match
+  The pattern components are assigned to distinct components in order, trying components in order,
+  and the first assignment that agrees on all shared variables is returned.
   """
-  if not pattern_components:
-    return partial_match,components
-  for pattern_component in pattern_components:
-    for component in components:
-      component_match = match_component_pattern(pattern_component,component,type_checker)
+  if match_memos is None:
+    match_memos = [None]*len(pattern_components)
+
+  # The match matrix: rows[p] lists the (component index, match) pairs of components matching pattern p
+  rows = []
+  for pattern_component,memory in zip(pattern_components,match_memos):
+    row = []
+    for ci,component in enumerate(components):
+      component_match = match_component_pattern_memoized(pattern_component,component,type_checker,memory)
       if component_match is not None:
         if 'o_auto' in component_match:
           raise Exception("Encountered component with a missing 'o' variable in mixture pattern "+str(pattern_component))
-        if all(k not in partial_match or component_match[k]==partial_match[k] for k in component_match):
-          pattern_components_reduced = copy.deepcopy(pattern_components)
-          pattern_components_reduced.remove(pattern_component)
-          components_reduced = copy.deepcopy(components)
-          components_reduced.remove(component)
-          partial_match_extended = copy.deepcopy(partial_match)
-          partial_match_extended.update(component_match)
-          match = match_mixture_pattern(pattern_components_reduced,components_reduced,type_checker,partial_match = partial_match_extended)
-          if match is not None:
-            return match
-  return None
+        row.append((ci,component_match))
+    if not row:
+      return None
+    rows.append(row)
+
+  # Hash each row into buckets keyed on the values of the variables it shares with earlier patterns,
+  # so the search below only visits components that agree with what is already bound.
+  seen_variables = set()
+  shared_variables = [] # shared_variables[p] lists the variables of pattern p bound by earlier patterns
+  new_variables = [] # new_variables[p] lists the variables first bound by pattern p
+  buckets = []
+  for row in rows:
+    variables = list(row[0][1].keys())
+    shared_variables.append([v for v in variables if v in seen_variables])
+    new_variables.append([v for v in variables if v not in seen_variables])
+    seen_variables.update(variables)
+    bucket = {}
+    for ci,component_match in row:
+      bucket.setdefault(join_key(component_match,shared_variables[-1]),[]).append((ci,component_match))
+    buckets.append(bucket)
+
+  used = [False]*len(components)
+  bindings = {}
+  def search(p):
+    if p==len(rows):
+      return True
+    for ci,component_match in buckets[p].get(join_key(bindings,shared_variables[p]),()):
+      if used[ci]: continue
+      used[ci] = True
+      for v in new_variables[p]:
+        bindings[v] = component_match[v]
+      if search(p+1):
+        return True
+      used[ci] = False
+    for v in new_variables[p]:
+      bindings.pop(v,None)
+    return False
+
+  if not search(0):
+    return None
+  return dict(bindings), [c for ci,c in enumerate(components) if not used[ci]]
@@ -1,7 +1,10 @@
-import os,sys
+import os,sys,hashlib
+from collections import Counter
 from util import Ingredient
+from cache import pickle_cached, CACHE_DIR
 
 INGREDIENTS_DIR = "ingredient_data"
+PARSER_VERSION = 2 # Bump this whenever parsing or the pickled form of the ingredients changes
 
 
 
@@ -14,10 +17,106 @@ def parse_inherit_list(s):
   return [name.strip() for name in s.split(',')]
 
 
-def parse(ingredients_dir):
+def directory_digest(ingredients_dir):
+  'Return a hash of the names, sizes and modification times of the files in ingredients_dir'
+  h = hashlib.sha256(str(PARSER_VERSION).encode())
+  for entry in sorted(os.scandir(ingredients_dir), key=lambda entry:entry.name):
+    if not entry.is_file(): continue
+    stat = entry.stat()
+    h.update('{}\0{}\0{}\n'.format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+  return h.hexdigest()[:16]
+
+
+class InheritanceResolver:
+  """ Resolves inheritance between the ingredient dicts in |ingredient_dicts_byname|.
+  The ancestors of an ingredient are put in a C3 linearization, like the method resolution order of Python classes,
+  except that later parents in an "inherit" list take precedence over earlier ones, since they override them.
+  Diamond inheritance thus gives each ancestor once. An attribute in |attributes| is taken from the first
+  ingredient in the linearization that defines it.
+  Linearizations and merged attributes are computed once per ingredient and remembered,
+  so resolving a whole catalog is linear in its size, for hierarchies of bounded depth.
+  Raises an exception for inheritance cycles, nonexistent parents, and hierarchies that have no linearization.
+  """
+  def __init__(self, ingredient_dicts_byname, attributes):
+    self.ingredient_dicts_byname = ingredient_dicts_byname
+    self.attributes = attributes
+    self.linearizations = {}
+    self.merged = {}
+    self.in_progress = [] # names whose linearization is being computed, to detect cycles
+
+  def parents(self, name):
+    ing_dict = self.ingredient_dicts_byname[name]
+    parents = parse_inherit_list(ing_dict["inherit"])
+    for parent in parents:
+      if parent not in self.ingredient_dicts_byname:
+        raise Exception("Ingredient in {} inherits nonexistent ingredient named {}".format(ing_dict["filepath"],parent))
+    return parents
+
+  def linearization(self, name):
+    'Return the list of |name| and its ancestors, from most to least specific'
+    if name in self.linearizations:
+      return self.linearizations[name]
+    if name in self.in_progress:
+      cycle = self.in_progress[self.in_progress.index(name):] + [name]
+      raise Exception("Inheritance cycle among ingredients: "+' -> '.join(cycle))
+    self.in_progress.append(name)
+    parents = self.parents(name)[::-1] # most specific first
+    sequences = [list(self.linearization(parent)) for parent in parents] + [parents]
+    self.in_progress.pop()
+
+    result = [name]
+    sequences = [seq for seq in sequences if seq]
+    while sequences:
+      for seq in sequences:
+        head = seq[0]
+        if not any(head in other[1:] for other in sequences):
+          break
+      else:
+        raise Exception("Cannot order the ancestors of ingredient {} consistently; check the order of the inherit lists of {}".format(
+          name, ', '.join([name]+parents)))
+      result.append(head)
+      sequences = [seq[1:] if seq[0]==head else seq for seq in sequences]
+      sequences = [seq for seq in sequences if seq]
+    self.linearizations[name] = result
+    return result
+
+  def inherited_from(self, name):
+    'Return the ancestors of |name|, from least to most specific'
+    return self.linearization(name)[:0:-1]
+
+  def merged_attributes(self, name):
+    'Return the dict of the attributes of |name|, including inherited ones'
+    if name not in self.merged:
+      merged = {}
+      for ancestor in reversed(self.linearization(name)):
+        ing_dict = self.ingredient_dicts_byname[ancestor]
+        merged.update((a,v) for a,v in ing_dict.items() if a in self.attributes)
+      self.merged[name] = merged
+    return self.merged[name]
+
+
+def parse(ingredients_dir, cache_dir=CACHE_DIR):
   """ Parse the ingredients in ingredients_dir and return list of Ingredient's
       See the docstring for Ingredient for what kind of things should end up in the list
+      The result is kept as a snapshot in |cache_dir|, which is used for as long as no file in ingredients_dir
+      is added, removed or modified (going by sizes and modification times). Pass cache_dir=None to always parse.
+      Warnings are printed either way.
   """
+  build = lambda : parse_uncached(ingredients_dir)
+  if cache_dir is None:
+    ingredients, warnings = build()
+  else:
+    name = 'ingredients_'+os.path.basename(os.path.normpath(ingredients_dir))
+    ingredients, warnings = pickle_cached(cache_dir, name, directory_digest(ingredients_dir), build)
+  for warning in warnings:
+    print(warning, file=sys.stderr)
+  return ingredients
+
+
+def parse_uncached(ingredients_dir):
+  'Parse the ingredients in ingredients_dir and return the list of Ingredients and the list of warnings'
+  warnings = []
+
   # Read all the ingredients into a list of dicts
   ingredient_dicts = []
   for filename in os.listdir(ingredients_dir):
@@ -52,12 +151,13 @@ def parse(ingredients_dir):
         raise Exception("Ingredient in {} is missing the required attribute '{}'".format(ing['filepath'],a))
 
   # Further validation and warnings
+  ingredients_per_file = Counter(ing['filepath'] for ing in ingredient_dicts)
   for ing in ingredient_dicts:
     if ing["abstract"] not in ["True", "False"]:
       raise Exception("Ingredient {} in {} has invalid value for attribute 'abstract'".format(ing['name'],ing['filepath']))
-    if len([i for i in ingredient_dicts if i['filepath']==ing['filepath']])==1:
+    if ingredients_per_file[ing['filepath']]==1:
       if ing["name"] != os.path.basename(ing['filepath']):
-        print("Warning: Ingredient in {} has name '{}' that does not match the filename. Was this intentional?".format(ing['filepath'],ing['name']), file=sys.stderr)
+        warnings.append("Warning: Ingredient in {} has name '{}' that does not match the filename. Was this intentional?".format(ing['filepath'],ing['name']))
 
 
   # Dict for to lookup ingredients by ingredient name
@@ -75,47 +175,24 @@ def parse(ingredients_dir):
   attributes.difference_update(["filepath"]+required_attributes)
 
 
-  # A function to recursively load in attributes from ancestors in inheritance tree
-  def load_attributes(target_ing, source_dict):
-    """target_ing is an Ingredient to load attributes into,
-    and source_dict is the ingredient dict from which to load them.
-    This will load attributes from source_dict's ancestors recursively.
-    It will also populate target_ing's inherited_form list, in the order
-    in which attributes are filled in."""
-
-    # First recurse to parents; we load in their attributes to be possibly overridden later
-    for name in parse_inherit_list(source_dict["inherit"]):
-      if name not in ingredient_dicts_byname:
-        raise Exception("Ingredient in {} inherits nonexistent ingredient named {}".format(ing_dict["filepath"],name))
-      load_attributes(target_ing, ingredient_dicts_byname[name])
-
-    source_name = source_dict['name']
-    if source_name != target_ing.name:
-      target_ing.inherited_from.append(source_name)
-
-    for a in source_dict:
-      if a in attributes:
-        target_ing.__dict__[a]=source_dict[a]
-
-
-
+  resolver = InheritanceResolver(ingredient_dicts_byname, attributes)
 
   ingredients = []  # List of Ingredient objects
   for ing_dict in ingredient_dicts:
     if ing_dict["abstract"]=="True": continue # We don't make entries for abstract ingredients
 
     ing = Ingredient(ing_dict["name"]) # Ingredient to be constructed and appended to ingredients list
-
-    load_attributes(ing, ing_dict) # Recursively load attributes from ancestors and finally self
+    ing.inherited_from = resolver.inherited_from(ing.name)
+    ing.__dict__.update(resolver.merged_attributes(ing.name))
 
     # Warn about seemingly missing attributes
     for a in attributes:
       if a not in ing.__dict__:
-        print("Warning: Attribute {} is never defined in the ingredient {}".format(a,ing.name),file=sys.stderr)
+        warnings.append("Warning: Attribute {} is never defined in the ingredient {}".format(a,ing.name))
 
     ingredients.append(ing)
 
-  return ingredients
+  return ingredients, warnings
 
 
 
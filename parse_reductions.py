@@ -1,8 +1,11 @@
-import itertools
-from component import ReductionRuleComponent
+import itertools, hashlib, importlib.util, os, sys
+from component import ReductionRuleComponent, Component, Token, interpret_compiled_component_pattern, substitute_tokens
 from mixture import ReductionRuleMixture, ReductionRuleComponentAsMixture
+from cache import pickle_cached, CACHE_DIR
 
 REDUCTIONS_FILENAME = "reductions"
+GENERATED_CODE_VERSION = 2 # Bump this whenever MatcherCodeGenerator changes the code it writes
+PARSER_VERSION = 1 # Bump this whenever parsing or the pickled form of the rules changes
 
 
 
@@ -41,18 +44,29 @@ def update_modifier_tags(modifier_tags,line):
 
 
 
-def parse(filepath):
+def parse(filepath, cache_dir=CACHE_DIR):
   """ Parse the reduction rules in filepath and return two things:
       the list of reduction rules
         (a variety of ReductionRuleMixture and ReductionRuleComponentAsMixture)
       and the dict of modifier tags
+      The result is cached in |cache_dir| under a hash of the file contents and PARSER_VERSION,
+      so that later calls just unpickle it. Pass cache_dir=None to always parse.
   """
+  with open(filepath) as f:
+    text = f.read()
+  if cache_dir is None:
+    return parse_text(text)
+  digest = hashlib.sha256('{}\n{}'.format(PARSER_VERSION,text).encode()).hexdigest()[:16]
+  name = 'parsed_'+os.path.basename(filepath)
+  return pickle_cached(cache_dir, name, digest, lambda : parse_text(text))
+
+
+def parse_text(text):
+  'Parse the contents of a reductions file, see parse'
   reduction_rules =[]
   modifier_tags = {}
 
-
-  f = open(filepath)
-  for line in f:
+  for line in text.splitlines():
     line = line.strip() # remove whitespace
     line = line.split('#')[0] # remove comments
     if not line: continue # skip blanks
@@ -65,11 +79,315 @@ def parse(filepath):
       update_modifier_tags(modifier_tags,line)
     else:
       raise Exception("Unable to parse line:",line)
-  f.close()
 
   return reduction_rules, modifier_tags
 
 
+class RuleAnalyzer:
+  """ Finds reduction rules that can never change anything, given the constants that can occur:
+  the ingredients named in |ingredient_names| and the modifiers named in |modifiers|, along with any
+  other modifiers, which have no tags. The rules must already use |type_checker|.
+  - A rule is dead if a pattern token (other than an o variable) has a qualifier that no constant
+    of its category satisfies, e.g. because it names a tag that nothing has.
+  - A component rule is shadowed if the rule right before it is a component rule that matches everything
+    it matches (see covers) and always rewrites what it matches (see always_rewrites): by the time the
+    shadowed rule is tried, the rule before it has rewritten everything it could match.
+  """
+  def __init__(self, type_checker, ingredient_names, modifiers):
+    self.type_checker = type_checker
+    ingredient_masks = [self.mask(name,'ing') for name in ingredient_names]
+    self.masks = { # tag masks of the constants of each category
+      'ing' : ingredient_masks,
+      'ingmod' : [self.mask(name,'ingmod') for name in ingredient_names],
+      'mod' : [self.mask(name,'mod') for name in modifiers] + [0],
+    }
+
+  def mask(self, name, category):
+    return self.type_checker.tag_mask_of_const(Token(name, ('const', category)))
+
+  def satisfiable(self, token):
+    'Whether some constant matches the pattern Token |token|'
+    if token.varness!='qvar':
+      return True
+    return any(map(token.qualifier.evaluate_mask, self.masks[token.category]))
+
+  def token_covers(self, general, specific):
+    'Whether the pattern Token |general| matches every constant that the pattern Token |specific| matches'
+    if general.category!=specific.category:
+      return False
+    if general.varness=='uqvar':
+      return True
+    if general.varness=='const':
+      return specific.varness=='const' and specific.name==general.name
+    if specific.varness=='const':
+      return general.qualifier.evaluate_mask(self.mask(specific.name, specific.category))
+    return all(general.qualifier.evaluate_mask(m) for m in self.masks[specific.category]
+      if specific.varness=='uqvar' or specific.qualifier.evaluate_mask(m))
+
+  def covers(self, general, specific):
+    """ Whether the CompiledComponentRuleLHS |general| matches every component that |specific| matches.
+    This is only decided for a |general| without strictness, dont_match or repeated variables, where it
+    holds if the tokens of |general| can be assigned distinct tokens of |specific| that they cover.
+    """
+    if general.strictness or general.dont_match is not None:
+      return False
+    variables = [t.name for t in general.tokens if t.varness!='const']
+    if len(set(variables))!=len(variables):
+      return False
+    def assign(index, used):
+      if index==len(general.tokens):
+        return True
+      return any(
+        assign(index+1, used|{j})
+        for j,token in enumerate(specific.tokens)
+        if j not in used and self.token_covers(general.tokens[index], token)
+      )
+    return assign(0, frozenset())
+
+  @staticmethod
+  def always_rewrites(rule):
+    """ Whether the ReductionRuleComponent |rule| changes every component it matches.
+    This is only decided when all the tokens left out of the match are passed on once, so that the
+    length of the component always changes by the same nonzero amount.
+    """
+    lhs = rule.compiled_lhs
+    o_names = [t.name for t in rule.rhs_tokens if t.category=='o']
+    if lhs.o_dict:
+      if len(lhs.o_dict)!=1 or any(q is not None for q in lhs.o_dict.values()) or o_names!=list(lhs.o_dict):
+        return False
+    elif o_names:
+      return False
+    return len(rule.rhs_tokens)-len(o_names) != len(lhs.tokens)
+
+  def analyze(self, rules):
+    'Return a list of (rule, message) pairs for the rules in the list |rules| that can never change anything'
+    findings = []
+    previous = None
+    for rule in rules:
+      component_rule = getattr(rule, 'component_rule', None)
+      patterns = [component_rule.compiled_lhs] if component_rule is not None else rule.compiled_lhs
+      unsatisfiable = [t.str for pattern in patterns for t in pattern.tokens if not self.satisfiable(t)]
+      if unsatisfiable:
+        findings.append((rule, "dead rule, since nothing matches {}: {}".format(', '.join(unsatisfiable), rule)))
+      elif component_rule is not None and previous is not None and self.always_rewrites(previous) \
+          and self.covers(previous.compiled_lhs, component_rule.compiled_lhs):
+        findings.append((rule, "rule shadowed by the rule before it, {}: {}".format(previous, rule)))
+      previous = component_rule
+    return findings
+
+
+def analyze_rules(rules, type_checker, ingredient_names, modifiers, warn=True):
+  'Return the findings of a RuleAnalyzer on |rules|, printing them as warnings if |warn|'
+  findings = RuleAnalyzer(type_checker, ingredient_names, modifiers).analyze(rules)
+  if warn:
+    for _, message in findings:
+      print("Warning: "+message, file=sys.stderr)
+  return findings
+
+
+class MatcherCodeGenerator:
+  """ Writes the source of a Python module with a specialized function for each pattern and rhs of some rules.
+  For a CompiledComponentRuleLHS the function is a matcher doing the same as
+  component.interpret_compiled_component_pattern, with one nested loop per pattern token,
+  and with the constants, categories, strictness and qualifiers of the pattern written into the code.
+  For the rhs of a rule the function is a builder, taking a match and returning the list of token strings
+  that component.substitute_tokens would put in the result.
+  Qualifiers are checked with the const_satisfies_qualifier of the type checker, like the interpreter does,
+  so that subclasses overriding it and its qualifier cache work the same in generated code.
+  """
+  def __init__(self):
+    self.lines = []
+    self.qualifier_names = {} # maps condition strings to names of their Cst in the module
+    self.matcher_count = 0
+    self.builder_count = 0
+
+  def qualifier(self, cst):
+    'Return the name of a module level copy of the condition_syntax_tree.Cst |cst|'
+    if cst.condition_string not in self.qualifier_names:
+      self.qualifier_names[cst.condition_string] = 'Q{}'.format(len(self.qualifier_names))
+    return self.qualifier_names[cst.condition_string]
+
+  def add_matcher(self, compiled):
+    'Write a matcher for the CompiledComponentRuleLHS |compiled| and return its name'
+    dont_match_name = None
+    if compiled.dont_match is not None:
+      dont_match_name = self.add_matcher(compiled.dont_match)
+    name = 'match_{}'.format(self.matcher_count)
+    self.matcher_count += 1
+
+    lines = ['def {}(T, tc):'.format(name), '  # '+str(compiled)]
+    if dont_match_name is not None:
+      lines.append('  if {}(T, tc) is not None: return None'.format(dont_match_name))
+    lines.append('  n = len(T)')
+    lines.append('  sat = tc.const_satisfies_qualifier')
+    indent = '  '
+    bound_at = {} # maps variables to the index of the loop that binds them
+    for k,token in enumerate(compiled.tokens):
+      if k==0 or not compiled.strictness:
+        target_range = 'range(n)'
+      elif compiled.strictness=='&':
+        target_range = 'range(j{}+1, n)'.format(k-1)
+      else:
+        target_range = 'range(j{0}+1, min(j{0}+2, n))'.format(k-1)
+      lines.append(indent+'for j{} in {}:'.format(k,target_range))
+      indent += '  '
+      if k>0 and not compiled.strictness:
+        lines.append(indent+'if {}: continue'.format(' or '.join('j{}==j{}'.format(k,i) for i in range(k))))
+      lines.append(indent+'t{0} = T[j{0}]'.format(k))
+      conditions = ['t{}.category!={!r}'.format(k,token.category)]
+      if token.varness=='const':
+        conditions.append('t{}.name!={!r}'.format(k,token.name))
+      elif token.varness=='qvar':
+        conditions.append('not sat(t{}, {})'.format(k,self.qualifier(token.qualifier)))
+      if token.varness!='const' and token.name in bound_at:
+        conditions.append('t{}.name!=t{}.name'.format(k,bound_at[token.name]))
+      lines.append(indent+'if {}: continue'.format(' or '.join(conditions)))
+      if token.varness!='const' and token.name not in bound_at:
+        bound_at[token.name] = k
+
+    lines.append(indent+'rest = [t for j,t in enumerate(T) if {}]'.format(' and '.join('j!=j{}'.format(k) for k in range(len(compiled.tokens)))))
+    entries = ['{!r}: t{}.name'.format(var,k) for var,k in bound_at.items()]
+    if not compiled.o_dict:
+      entries.append("'o_auto': [t.name for t in rest]")
+    for ovar,qualifier in compiled.o_dict.items():
+      condition = '' if qualifier is None else ' if sat(t, {})'.format(self.qualifier(qualifier))
+      entries.append('{!r}: [t.name for t in rest{}]'.format(ovar,condition))
+    lines.append(indent+'return {'+', '.join(entries)+'}')
+    lines.append('  return None')
+    self.lines += lines + ['','']
+    return name
+
+  def add_builder(self, rhs_tokens, o_auto):
+    """ Write a builder for the list of Tokens |rhs_tokens| and return its name.
+    If |o_auto| is True the match will have an 'o_auto' entry, which goes first.
+    """
+    name = 'build_{}'.format(self.builder_count)
+    self.builder_count += 1
+    items = ["*m['o_auto']"] if o_auto else []
+    for token in rhs_tokens:
+      if token.category=='o':
+        items.append('*m[{!r}]'.format(token.name))
+      elif token.varness in ['uqvar','qvar']:
+        items.append('m[{!r}]'.format(token.name))
+      else:
+        items.append(repr(token.name))
+    self.lines += ['def {}(m):'.format(name), '  return ['+', '.join(items)+']', '', '']
+    return name
+
+  def source(self):
+    header = [
+      '# Generated by parse_reductions.compile_rules. Do not edit.',
+      '# Code version {}'.format(GENERATED_CODE_VERSION),
+      'from condition_syntax_tree import Cst',
+      '',
+    ]
+    header += ['{} = Cst({!r})'.format(name,condition) for condition,name in self.qualifier_names.items()]
+    return '\n'.join(header + ['',''] + self.lines)
+
+
+def load_generated_module(source, cache_dir):
+  """ Load the Python module with the given source, which is cached in |cache_dir| under the hash of the source.
+  If the cache cannot be written, the module is built in memory instead.
+  """
+  digest = hashlib.sha256(source.encode()).hexdigest()[:16]
+  module_name = 'generated_rules_'+digest
+  path = os.path.join(cache_dir, module_name+'.py')
+  try:
+    if not os.path.isfile(path):
+      os.makedirs(cache_dir, exist_ok=True)
+      tmp_path = '{}.{}.tmp'.format(path,os.getpid())
+      with open(tmp_path,'w') as f:
+        f.write(source)
+      os.replace(tmp_path, path)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  except OSError as e:
+    print("Warning: could not use generated rule code cache in {} ({}). Compiling in memory.".format(cache_dir,e), file=sys.stderr)
+    module = type(sys)(module_name)
+    exec(compile(source, '<generated rules>', 'exec'), module.__dict__)
+  return module
+
+
+def verified_matcher(compiled, generated_matcher):
+  'Wrap |generated_matcher| so that it also interprets |compiled| and raises an exception if they disagree'
+  def matcher(target_tokens, type_checker):
+    match = generated_matcher(target_tokens, type_checker)
+    expected = interpret_compiled_component_pattern(compiled, target_tokens, type_checker)
+    if match!=expected:
+      raise Exception("Generated matcher for '{}' gave {} instead of {} on '{}'".format(
+        compiled, match, expected, ' '.join(t.name for t in target_tokens)))
+    return match
+  return matcher
+
+def verified_builder(rhs_tokens, generated_builder):
+  'Wrap |generated_builder| so that it also interprets |rhs_tokens| and raises an exception if they disagree'
+  def builder(match):
+    tokens = generated_builder(match)
+    expected = substitute_tokens(rhs_tokens, match)
+    if Component(tokens)!=expected:
+      raise Exception("Generated builder gave '{}' instead of '{}' for {}".format(' '.join(tokens), expected, match))
+    return tokens
+  return builder
+
+
+def compile_rules(rules, cache_dir=CACHE_DIR, verify=False):
+  """ Generate specialized Python matchers and builders for the rules (see MatcherCodeGenerator),
+  load them (from the cache in |cache_dir| if the same code was generated before), and attach them to the rules.
+  The code is specific to each rule's current type checker; calling set_type_checker on a rule
+  drops it, and the rule goes back to being interpreted until compile_rules is called again.
+  If |verify| is True, every match and substitution is also interpreted and compared,
+  raising an exception on any difference.
+  Return the generated module.
+  """
+  generator = MatcherCodeGenerator()
+  attachments = [] # (object, attribute name, function name or list of function names, wrapper)
+  for rule in rules:
+    if isinstance(rule, ReductionRuleComponentAsMixture):
+      rule = rule.component_rule
+    if isinstance(rule, ReductionRuleComponent):
+      patterns = [rule.compiled_lhs]
+      builder_name = generator.add_builder(rule.rhs_tokens, not rule.compiled_lhs.o_dict)
+      attachments.append((rule, 'generated_builder', builder_name, lambda f,tokens=rule.rhs_tokens : verified_builder(tokens,f)))
+    else:
+      patterns = rule.compiled_lhs
+      builder_names = [generator.add_builder(tokens, False) for tokens in rule.rhs_tokens]
+      attachments.append((rule, 'generated_builders', builder_names, None))
+    for compiled in patterns:
+      while compiled is not None:
+        attachments.append((compiled, 'generated_matcher', generator.add_matcher(compiled), lambda f,c=compiled : verified_matcher(c,f)))
+        compiled = compiled.dont_match
+
+  module = load_generated_module(generator.source(), cache_dir)
+  for obj, attribute, function_names, wrapper in attachments:
+    if isinstance(function_names, list):
+      functions = [getattr(module,name) for name in function_names]
+      if verify:
+        functions = [verified_builder(tokens,f) for tokens,f in zip(obj.rhs_tokens,functions)]
+      setattr(obj, attribute, functions)
+    else:
+      function = getattr(module,function_names)
+      setattr(obj, attribute, wrapper(function) if verify else function)
+  return module
+
+
+def decompile_rules(rules):
+  'Remove code attached by compile_rules, so that the rules are interpreted again'
+  for rule in rules:
+    if isinstance(rule, ReductionRuleComponentAsMixture):
+      rule = rule.component_rule
+    if isinstance(rule, ReductionRuleComponent):
+      rule.generated_builder = None
+      patterns = [rule.compiled_lhs]
+    else:
+      rule.generated_builders = None
+      patterns = rule.compiled_lhs
+    for compiled in patterns:
+      while compiled is not None:
+        compiled.generated_matcher = None
+        compiled = compiled.dont_match
+
+
 def main():
   reduction_rules, modifier_tags = parse(REDUCTIONS_FILENAME)
 
@@ -0,0 +1,369 @@
+""" Kitchen service: serves many cooking sessions from one long lived process.
+Clients send JSON requests over TCP or a Unix socket, one per line, and get one JSON line back for each,
+carrying the same 'id'. Requests on a connection may be pipelined, and responses can come back out of order.
+  {"id": 1, "op": "new_session"}                          -> {"id": 1, "session": "1"}
+  {"id": 2, "op": "get", "session": "1", "arg": "Oat"}    -> {"id": 2, "foods": [...], "output": "..."}
+  {"id": 3, "op": "reduce_mixture", "mixture": "(powdered Oat) + (Water)", "display": false}
+                                                          -> {"id": 3, "mixture": "(Oat Dough)"}
+A failed request gets {"id": ..., "error": message} instead.
+Operations:
+- new_session, close_session: sessions belong to the connection that made them and end with it
+- get, cut, mush, strain, cook, mix, pot: run the command of interactive.py with argument 'arg' on the
+  foods of 'session', and return the foods along with whatever the command printed
+- foods: return the foods of 'session'
+- reduce_mixture: reduce 'mixture', for display if 'display' is true
+- ingredients: return the list of gettable ingredients
+- stats: return counts of requests, batches and reduced mixtures
+The foods of a session are kept in the server, and each command runs on a copy of them in a worker of a
+pool, so the event loop only ever does I/O. Commands on the same session run one at a time, in order.
+Concurrent reduce_mixture requests, from any connections, are gathered into batches that are each
+reduced by one worker call; see ReductionBatcher.
+
+  python server.py serve --port 8765
+  python server.py load --port 8765 --sessions 50
+"""
+import sys, io, json, time, random, asyncio, argparse, itertools, threading, contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from mixture import Mixture
+
+SESSION_COMMANDS = ['get', 'cut', 'mush', 'strain', 'cook', 'mix', 'pot']
+
+
+# ----- worker side -----
+
+# The Kitchen of a worker is kept per thread, since its caches are not thread safe:
+# each thread of a thread pool has a Kitchen of its own, like each process of a process pool.
+worker = threading.local()
+
+def init_worker(kitchen_kwargs):
+  'Load a Kitchen made with |kitchen_kwargs| for the worker running this, with its reduction systems ready'
+  import interactive
+  worker.kitchen = interactive.Kitchen(**kitchen_kwargs)
+  worker.kitchen.rs, worker.kitchen.rs_display
+
+def reduce_batch(requests):
+  'Reduce each (mixture string, display) pair of |requests|, returning a list of (mixture string, error) pairs'
+  results = []
+  for mixture_str, display in requests:
+    try:
+      results.append((str(worker.kitchen.reduce_mixture(display, Mixture(mixture_str))), None))
+    except Exception as e:
+      results.append((None, str(e)))
+  return results
+
+def run_command(foods, command, arg):
+  """ Run the IngredientsCmd |command| with |arg| on foods given as a list of (Mixture, in_container) pairs,
+  or only describe the foods if |command| is None.
+  Return the new list of pairs, a description of each food as a dict, and what the command printed.
+  """
+  import interactive
+  kitchen = worker.kitchen
+  icmd = interactive.IngredientsCmd(kitchen)
+  icmd.foods = [interactive.Food(Mixture(mixture), in_container, kitchen=kitchen) for mixture, in_container in foods]
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    if command is not None:
+      getattr(icmd, 'do_'+command)(arg)
+      icmd.tidy_foods()
+  descriptions = [
+    {'mixture' : str(food.mixture), 'display' : food.__str__(), 'in_container' : food.in_container}
+    for food in icmd.foods
+  ]
+  return [(food.mixture, food.in_container) for food in icmd.foods], descriptions, output.getvalue()
+
+def gettable_ingredients():
+  return worker.kitchen.gettable_ingredients
+
+
+# ----- server side -----
+
+class ReductionBatcher:
+  """ Gathers reduce requests into batches of at most |batch_size|, each reduced by one call of reduce_batch
+  on |executor|. A batch is sent off as soon as it is full, or |batch_delay| seconds after its first request,
+  so a lone request waits at most that long, and under load the cost of a worker call is shared by many.
+  Several batches can be in the workers at once.
+  """
+  def __init__(self, executor, batch_size=64, batch_delay=0.002):
+    self.executor = executor
+    self.batch_size = batch_size
+    self.batch_delay = batch_delay
+    self.queue = asyncio.Queue()
+    self.in_flight = set()
+    self.batches = 0
+    self.mixtures = 0
+
+  async def reduce(self, mixture_str, display):
+    'Return the string of the reduced form of the mixture |mixture_str|'
+    future = asyncio.get_running_loop().create_future()
+    self.queue.put_nowait((mixture_str, display, future))
+    return await future
+
+  async def run(self):
+    'Send off batches forever'
+    while True:
+      batch = [await self.queue.get()]
+      if self.queue.qsize() < self.batch_size-1:
+        await asyncio.sleep(self.batch_delay)
+      while len(batch) < self.batch_size and not self.queue.empty():
+        batch.append(self.queue.get_nowait())
+      task = asyncio.ensure_future(self.submit(batch))
+      self.in_flight.add(task)
+      task.add_done_callback(self.in_flight.discard)
+
+  async def submit(self, batch):
+    self.batches += 1
+    self.mixtures += len(batch)
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(
+        self.executor, reduce_batch, [(mixture_str, display) for mixture_str, display, _ in batch])
+    except Exception as e:
+      results = [(None, str(e))]*len(batch)
+    for (_, _, future), (reduced, error) in zip(batch, results):
+      if future.done():
+        continue
+      if error is not None:
+        future.set_exception(Exception(error))
+      else:
+        future.set_result(reduced)
+
+
+class Session:
+  def __init__(self):
+    self.foods = [] # list of (Mixture, in_container) pairs
+    self.lock = asyncio.Lock()
+
+
+class KitchenServer:
+  """ The service described in the module docstring. Work is done on a pool of |workers| processes,
+  or threads if |executor| is 'thread', each with a Kitchen of its own made with |kitchen_kwargs|.
+  """
+  def __init__(self, workers=None, executor='process', batch_size=64, batch_delay=0.002, kitchen_kwargs=None):
+    if kitchen_kwargs is None:
+      kitchen_kwargs = {}
+    if executor=='process':
+      self.executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(kitchen_kwargs,))
+    elif executor=='thread':
+      self.executor = ThreadPoolExecutor(workers, initializer=init_worker, initargs=(kitchen_kwargs,))
+    else:
+      raise Exception("Unknown executor '{}'. Options are: process, thread".format(executor))
+    self.batcher = ReductionBatcher(self.executor, batch_size, batch_delay)
+    self.session_ids = itertools.count(1)
+    self.requests = 0
+    self.server = None
+    self.batcher_task = None
+
+  async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+    'Start listening on |unix_path| if given, or else on |host| and |port|. Return the asyncio server.'
+    self.batcher_task = asyncio.ensure_future(self.batcher.run())
+    if unix_path is not None:
+      self.server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+    else:
+      self.server = await asyncio.start_server(self.handle_connection, host, port)
+    return self.server
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+    self.batcher_task.cancel()
+    self.executor.shutdown()
+
+  async def run_in_worker(self, f, *args):
+    return await asyncio.get_running_loop().run_in_executor(self.executor, f, *args)
+
+  async def handle_connection(self, reader, writer):
+    sessions = {}
+    write_lock = asyncio.Lock()
+    tasks = set()
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        task = asyncio.ensure_future(self.respond(line, sessions, writer, write_lock))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+      if tasks:
+        await asyncio.wait(tasks)
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def respond(self, line, sessions, writer, write_lock):
+    self.requests += 1
+    request_id = None
+    try:
+      request = json.loads(line)
+      request_id = request.get('id')
+      response = await self.dispatch(request, sessions)
+    except Exception as e:
+      response = {'error' : str(e)}
+    response['id'] = request_id
+    async with write_lock:
+      writer.write((json.dumps(response)+'\n').encode())
+      await writer.drain()
+
+  def session(self, request, sessions):
+    if request.get('session') not in sessions:
+      raise Exception("No such session: {}".format(request.get('session')))
+    return sessions[request['session']]
+
+  async def dispatch(self, request, sessions):
+    op = request.get('op')
+    if op=='new_session':
+      session_id = str(next(self.session_ids))
+      sessions[session_id] = Session()
+      return {'session' : session_id}
+    if op=='close_session':
+      self.session(request, sessions)
+      del sessions[request['session']]
+      return {}
+    if op in SESSION_COMMANDS or op=='foods':
+      session = self.session(request, sessions)
+      async with session.lock:
+        command = op if op in SESSION_COMMANDS else None
+        session.foods, descriptions, output = await self.run_in_worker(run_command, session.foods, command, str(request.get('arg','')))
+      return {'foods' : descriptions, 'output' : output}
+    if op=='reduce_mixture':
+      return {'mixture' : await self.batcher.reduce(request['mixture'], bool(request.get('display')))}
+    if op=='ingredients':
+      return {'ingredients' : await self.run_in_worker(gettable_ingredients)}
+    if op=='stats':
+      return {'requests' : self.requests, 'batches' : self.batcher.batches, 'reduced' : self.batcher.mixtures}
+    raise Exception("Unknown operation '{}'".format(op))
+
+
+# ----- client side -----
+
+class KitchenClient:
+  """ Client of a KitchenServer, over one connection. Any number of requests can be awaited concurrently. """
+  def __init__(self):
+    self.request_ids = itertools.count(1)
+    self.pending = {} # maps request ids to futures of their responses
+    self.reader_task = None
+
+  async def connect(self, host='127.0.0.1', port=8765, unix_path=None):
+    if unix_path is not None:
+      self.reader, self.writer = await asyncio.open_unix_connection(unix_path)
+    else:
+      self.reader, self.writer = await asyncio.open_connection(host, port)
+    self.reader_task = asyncio.ensure_future(self.read_responses())
+    return self
+
+  async def read_responses(self):
+    while True:
+      line = await self.reader.readline()
+      if not line:
+        break
+      response = json.loads(line)
+      future = self.pending.pop(response['id'], None)
+      if future is not None and not future.done():
+        future.set_result(response)
+    for future in self.pending.values():
+      future.set_exception(ConnectionError("Connection to kitchen server closed"))
+    self.pending.clear()
+
+  async def request(self, op, **fields):
+    'Send a request and return its response as a dict, raising an Exception if it is an error'
+    request_id = next(self.request_ids)
+    future = asyncio.get_running_loop().create_future()
+    self.pending[request_id] = future
+    self.writer.write((json.dumps(dict(fields, id=request_id, op=op))+'\n').encode())
+    await self.writer.drain()
+    response = await future
+    if 'error' in response:
+      raise Exception(response['error'])
+    return response
+
+  async def close(self):
+    self.writer.close()
+    await self.writer.wait_closed()
+    self.reader_task.cancel()
+
+
+async def load_test(address, sessions=20, reductions=200, seed=0):
+  """ Run |sessions| random cooking sessions and |reductions| reduce_mixture requests concurrently against the
+  server at |address| (the keyword arguments of KitchenClient.connect), each session on a connection of its own.
+  Return a dict with the number of requests, the seconds taken, and latency percentiles.
+  """
+  latencies = []
+  async def timed(client, op, **fields):
+    start = time.perf_counter()
+    try:
+      return await client.request(op, **fields)
+    finally:
+      latencies.append(time.perf_counter()-start)
+
+  async def cook(rng, ingredients):
+    client = await KitchenClient().connect(**address)
+    session = (await timed(client, 'new_session'))['session']
+    for ing_name in rng.sample(ingredients, rng.randint(2,4)):
+      foods = (await timed(client, 'get', session=session, arg=ing_name))['foods']
+    for i in range(len(foods)):
+      foods = (await timed(client, rng.choice(['cut','mush','pot']), session=session, arg=str(i)))['foods']
+    if len(foods)>1:
+      foods = (await timed(client, 'mix', session=session, arg=' '.join(map(str,range(len(foods))))))['foods']
+    await timed(client, 'cook', session=session, arg='0')
+    await client.close()
+
+  async def reduce(rng, ingredients):
+    client = await KitchenClient().connect(**address)
+    modifiers = ['sliced', 'mushed', 'cooked']
+    requests = []
+    for _ in range(reductions):
+      components = ['({} {})'.format(' '.join(rng.sample(modifiers, rng.randint(0,2))), rng.choice(ingredients)) for _ in range(rng.randint(1,3))]
+      requests.append(timed(client, 'reduce_mixture', mixture=' + '.join(components)))
+    await asyncio.gather(*requests)
+    await client.close()
+
+  rng = random.Random(seed)
+  client = await KitchenClient().connect(**address)
+  ingredients = (await client.request('ingredients'))['ingredients']
+  start = time.perf_counter()
+  await asyncio.gather(reduce(random.Random(rng.random()), ingredients),
+    *[cook(random.Random(rng.random()), ingredients) for _ in range(sessions)])
+  elapsed = time.perf_counter()-start
+  stats = await client.request('stats')
+  await client.close()
+  latencies.sort()
+  return {
+    'requests' : len(latencies),
+    'seconds' : elapsed,
+    'requests_per_sec' : len(latencies)/elapsed,
+    'p50_latency' : latencies[len(latencies)//2],
+    'p99_latency' : latencies[min(len(latencies)-1, len(latencies)*99//100)],
+    'mean_batch_size' : stats['reduced']/max(1,stats['batches']),
+  }
+
+
+async def serve(args):
+  server = KitchenServer(args.workers, args.executor, args.batch_size, args.batch_delay)
+  await server.start(args.host, args.port, args.unix)
+  print("Serving on {}".format(args.unix or '{}:{}'.format(args.host, args.port)), file=sys.stderr)
+  async with server.server:
+    await server.server.serve_forever()
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve cooking sessions and reductions over a socket, or load test a server")
+  parser.add_argument('mode', choices=['serve', 'load'])
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--unix', default=None, help="path of a Unix socket to use instead of TCP")
+  parser.add_argument('--workers', type=int, default=None, help="number of workers (default: number of cores)")
+  parser.add_argument('--executor', default='process', choices=['process', 'thread'])
+  parser.add_argument('--batch-size', type=int, default=64, help="maximum number of mixtures reduced per worker call")
+  parser.add_argument('--batch-delay', type=float, default=0.002, help="seconds to wait for a batch to fill up")
+  parser.add_argument('--sessions', type=int, default=20, help="number of concurrent sessions to load test with")
+  parser.add_argument('--reductions', type=int, default=200, help="number of concurrent reduce requests to load test with")
+  args = parser.parse_args()
+  if args.mode=='serve':
+    asyncio.run(serve(args))
+  else:
+    address = {'unix_path' : args.unix} if args.unix else {'host' : args.host, 'port' : args.port}
+    result = asyncio.run(load_test(address, args.sessions, args.reductions))
+    print("{requests} requests in {seconds:.2f}s: {requests_per_sec:.1f} requests/sec, "
+      "p50 latency {p50_latency:.4f}s, p99 latency {p99_latency:.4f}s, mean batch size {mean_batch_size:.1f}".format(**result))
+
+
+if __name__ == '__main__':
+  main()
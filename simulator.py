@@ -0,0 +1,150 @@
+""" Headless Monte Carlo cooking simulator.
+Runs many random cooking sessions like random_cook.py, without printing, spread over a pool of processes,
+and writes one JSON line per session with the seed, the commands run, the final foods, and the time taken.
+Session i uses the seed |seed|+i, and a session run with seed s does exactly what random_cook.py does
+after random.seed(s).
+  python simulator.py -n 1000 --seed 0 -o sessions.jsonl
+"""
+import sys, io, json, time, random, argparse, contextlib, multiprocessing
+
+
+def cook_session(icmd, rng, report=lambda : None, say=lambda message : None):
+  """ Run a random cooking session on the IngredientsCmd |icmd|, drawing random numbers from |rng|
+  (a random.Random, or the random module itself). |report| is called at the end of each stage,
+  and |say| with a message at the start of each stage.
+  Return the list of [command, argument] pairs that were run.
+  """
+  kitchen = icmd.kitchen
+  trace = []
+  def do(command, arg):
+    trace.append([command, arg])
+    getattr(icmd, 'do_'+command)(arg)
+
+  say("Gathering some ingredients...")
+
+  ingdts_to_use = rng.sample(kitchen.gettable_ingredients,int(rng.normalvariate(3,1)+1))
+  for ing_name in ingdts_to_use:
+    do('get', ing_name)
+  report()
+
+  say("Cutting up...")
+
+  for i in range(len(icmd.foods)):
+    rand = rng.random()
+    if rand < 0.15 :
+      do('cut', str(i))
+    elif rand < 0.3 :
+      do('cut', str(i))
+      do('cut', str(i))
+    elif rand < 0.45 :
+      do('cut', str(i))
+      do('cut', str(i))
+      do('cut', str(i))
+    elif rand < 0.6:
+      do('mush', str(i))
+
+  report()
+
+
+  say("Preparing for cooking...")
+
+  fats = [i for i in kitchen.ingredients_byname if 'Fat' in kitchen.ingredients_byname[i].inherited_from]
+  def mix(list_of_indices):
+    if len(list_of_indices)==1:
+      return
+    do('mix', ' '.join(list(map(str,list_of_indices))))
+  def get_and_mix_in(ing_name, index_to_mix_into):
+    do('get', ing_name)
+    mix([index_to_mix_into,len(icmd.foods)-1])
+
+  for i in range(len(icmd.foods)):
+    rand = rng.random()
+    if rand < 0.3 :
+      fat = rng.choice(fats)
+      get_and_mix_in(fat, i)
+    elif rand < 0.6:
+      get_and_mix_in('Water', i)
+    elif rand < 0.9:
+      pass # just keep it in baking mode
+    else:
+      do('pot', str(i))
+
+  report()
+
+
+  say("Mixing some things...")
+
+  num_to_mix = len(icmd.foods)//2 + 1
+  ones_to_mix = rng.sample(range(len(icmd.foods)),num_to_mix)
+  mix(ones_to_mix)
+
+  report()
+
+  say("Cooking...")
+
+  for i in range(len(icmd.foods)):
+    if rng.random()<0.8:
+      do('cook', str(i))
+
+  report()
+
+  say("Final mix...")
+
+  mix(range(len(icmd.foods)))
+
+  report()
+  return trace
+
+
+def run_session(seed, kitchen=None):
+  'Run a silent cook_session with the given seed and return its outcome as a dict that can be dumped as JSON'
+  import interactive
+  icmd = interactive.IngredientsCmd(kitchen)
+  icmd.foods = []
+  outcome = {'seed' : seed, 'actions' : None, 'foods' : None, 'error' : None}
+  start = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(io.StringIO()): # actions print messages
+      outcome['actions'] = cook_session(icmd, random.Random(seed))
+    outcome['foods'] = [
+      {'mixture' : str(food.mixture), 'display' : food.__str__(), 'in_container' : food.in_container}
+      for food in icmd.foods
+    ]
+  except Exception as e:
+    outcome['error'] = "{}: {}".format(type(e).__name__, e)
+  outcome['seconds'] = time.perf_counter()-start
+  return outcome
+
+
+def simulate(n, seed=0, processes=None, chunk_size=16):
+  'Yield the outcomes of |n| sessions with seeds seed, seed+1, ..., in order, run on a pool of |processes|'
+  seeds = range(seed, seed+n)
+  if processes==1:
+    yield from map(run_session, seeds)
+    return
+  with multiprocessing.Pool(processes) as pool:
+    yield from pool.imap(run_session, seeds, chunk_size)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Run random cooking sessions and write their outcomes as JSON lines")
+  parser.add_argument('-n', type=int, default=100, help="number of sessions")
+  parser.add_argument('--seed', type=int, default=0, help="seed of the first session")
+  parser.add_argument('--processes', type=int, default=None, help="number of worker processes (default: number of cores)")
+  parser.add_argument('-o', '--output', default='-', help="path of the JSONL file to write, or - for stdout")
+  args = parser.parse_args()
+
+  out = sys.stdout if args.output=='-' else open(args.output, 'w')
+  start = time.perf_counter()
+  errors = 0
+  for outcome in simulate(args.n, args.seed, args.processes):
+    errors += outcome['error'] is not None
+    print(json.dumps(outcome), file=out)
+  elapsed = time.perf_counter()-start
+  if out is not sys.stdout:
+    out.close()
+  print("{} sessions ({} failed) in {:.2f}s: {:.1f} sessions/sec".format(args.n, errors, elapsed, args.n/elapsed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,10 +1,281 @@
 import unittest
+import copy
+import pickle
+import itertools
+import os
+import tempfile
+import io
+import contextlib
 import parse_reductions
-from util import Ingredient,ReductionSystem
+import parse_ingredients
+import closure_table
+import interactive
+import simulator
+import server as server_module
+import asyncio
+import condition_syntax_tree
+from util import Ingredient,ReductionSystem,ReductionCycleError,apply_till_no_change,RuleIndex,pattern_anchor
+from cache import LRUCache
 from component import *
 from mixture import *
 
 
+cache_dir = None # temporary directory for the on-disk caches, so that tests write nothing into the repo
+
+def setUpModule():
+  global cache_dir
+  cache_dir = tempfile.TemporaryDirectory()
+  interactive._default_kitchen = interactive.Kitchen(cache_dir=cache_dir.name)
+
+def tearDownModule():
+  interactive._default_kitchen = None
+  cache_dir.cleanup()
+
+
+class TestComponent(unittest.TestCase):
+
+  def test_interning(self):
+    c = Component("salty sliced Onion")
+    self.assertEqual(c, Component(["salty", "sliced", "Onion"]))
+    self.assertEqual(hash(c), hash(Component("salty sliced Onion")))
+    self.assertNotEqual(c, Component("sliced salty Onion"))
+    self.assertEqual(["salty", "sliced", "Onion"], c.tokens)
+    self.assertEqual(c.ids, symbol_table.intern_all(c.tokens))
+
+  def test_immutable(self):
+    c = Component("sliced Onion")
+    with self.assertRaises(AttributeError):
+      c.tokens = ["fried"] + c.tokens
+    c.tokens.append("Onion")
+    self.assertEqual("sliced Onion", str(c))
+
+  def test_copy_and_pickle(self):
+    c = Component("salty sliced Onion")
+    self.assertEqual(c, copy.deepcopy(c))
+    self.assertEqual(c, pickle.loads(pickle.dumps(c)))
+
+
+class TestConditionSyntaxTree(unittest.TestCase):
+
+  def test_evaluate(self):
+    # condition string, equivalent python expression
+    examples = [
+      ("a", "a"),
+      ("!a", "not a"),
+      ("a&b", "a and b"),
+      ("a|b|c", "a or b or c"),
+      ("(cooked&!boiled)", "cooked and not boiled"),
+      ("a|!b", "a or not b"),
+      ("!(a|b)&c", "not (a or b) and c"),
+      ("(a&b)|(!a&c)|!!b", "(a and b) or (not a and c) or b"),
+    ]
+    for condition_string, expression in examples:
+      cst = condition_syntax_tree.Cst(condition_string)
+      symbols = sorted(set(cst.symbols()))
+      for values in itertools.product([False,True], repeat=len(symbols)):
+        truth_mapping = dict(zip(symbols,values))
+        expected = eval(expression, {}, truth_mapping)
+        self.assertEqual(expected, cst.evaluate(truth_mapping), (condition_string, truth_mapping))
+        mask = condition_syntax_tree.tag_mask(s for s in symbols if truth_mapping[s])
+        self.assertEqual(expected, cst.evaluate_mask(mask))
+
+  def test_symbols(self):
+    self.assertEqual(['Ingredient','flavor'], condition_syntax_tree.Cst("Ingredient|flavor").symbols())
+    self.assertEqual(['a','b','c'], condition_syntax_tree.Cst("!(a|b)&c").symbols())
+
+
+class TestLRUCache(unittest.TestCase):
+
+  def test_eviction(self):
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', None)
+    self.assertEqual(1, cache.get('a'))
+    cache.put('c', 3) # evicts 'b', the least recently used
+    self.assertNotIn('b', cache)
+    self.assertIsNone(cache.get('b', None))
+    self.assertEqual(3, cache.get('c'))
+    self.assertEqual({'hits':2, 'misses':1, 'evictions':1, 'size':2, 'maxsize':2}, cache.info())
+
+
+class TestParseIngredients(unittest.TestCase):
+
+  def write(self, path, text):
+    with open(path, 'w') as f:
+      f.write(text)
+
+  def test_snapshot(self):
+    with tempfile.TemporaryDirectory() as directory:
+      data_dir = os.path.join(directory, 'data')
+      cache_dir = os.path.join(directory, 'cache')
+      os.mkdir(data_dir)
+      self.write(os.path.join(data_dir, 'Grain'), "name: Grain\nabstract: True\ninherit: None\nslice: nothing\n")
+      self.write(os.path.join(data_dir, 'Oat'), "name: Oats\nabstract: False\ninherit: Grain\n")
+      for _ in range(2):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+          ingredients = parse_ingredients.parse(data_dir, cache_dir)
+        self.assertEqual([('Oats',['Grain'],'nothing')], [(i.name,i.inherited_from,i.slice) for i in ingredients])
+        self.assertIn("does not match the filename", stderr.getvalue())
+      self.write(os.path.join(data_dir, 'Oat'), "name: Oat\nabstract: False\ninherit: Grain\nslice: gain_mod sliced\n")
+      stderr = io.StringIO()
+      with contextlib.redirect_stderr(stderr):
+        ingredients = parse_ingredients.parse(data_dir, cache_dir)
+      self.assertEqual([('Oat','gain_mod sliced')], [(i.name,i.slice) for i in ingredients])
+      self.assertEqual('', stderr.getvalue())
+      self.assertEqual(1, len(os.listdir(cache_dir)))
+
+
+  def test_inheritance_resolution(self):
+    def ing_dict(name, inherit, **attributes):
+      return dict(name=name, inherit=inherit, abstract='True', filepath=name, **attributes)
+    dicts = [
+      ing_dict('Solid', 'None', slice='gain_mod sliced', mush='nothing'),
+      ing_dict('Veg', 'Solid', mush='gain_mod mashed'),
+      ing_dict('Soggy', 'Solid'),
+      ing_dict('Cooked', 'Veg, Soggy', cook='nothing'),
+      ing_dict('A', 'B'),
+      ing_dict('B', 'A'),
+    ]
+    resolver = parse_ingredients.InheritanceResolver({d['name']:d for d in dicts}, {'slice','mush','cook'})
+    self.assertEqual(['Cooked','Soggy','Veg','Solid'], resolver.linearization('Cooked'))
+    self.assertEqual(['Solid','Veg','Soggy'], resolver.inherited_from('Cooked'))
+    self.assertEqual(
+      {'slice':'gain_mod sliced', 'mush':'gain_mod mashed', 'cook':'nothing'},
+      resolver.merged_attributes('Cooked')
+    )
+    with self.assertRaisesRegex(Exception, 'A -> B -> A'):
+      resolver.linearization('A')
+
+
+class TestKitchen(unittest.TestCase):
+
+  def make_kitchen(self, directory):
+    data_dir = os.path.join(directory, 'data')
+    os.mkdir(data_dir)
+    with open(os.path.join(data_dir, 'Potato'), 'w') as f:
+      f.write("name: Potato\nabstract: False\ninherit: None\nslice: gain_mod chopped\n"
+        "drain: separate_out; gain_mod drained\nvanish: delete; gain_mod gone\n")
+    with open(os.path.join(directory, 'reductions'), 'w') as f:
+      f.write("chopped chopped i1 -> diced i1\n")
+    with open(os.path.join(directory, 'reductions_display'), 'w') as f:
+      f.write("diced Potato -> Fries\n")
+    return interactive.Kitchen(data_dir, os.path.join(directory, 'reductions'),
+      os.path.join(directory, 'reductions_display'), os.path.join(directory, 'cache'))
+
+  def test_alternate_data(self):
+    with tempfile.TemporaryDirectory() as directory:
+      kitchen = self.make_kitchen(directory)
+      self.assertEqual({}, kitchen.load_stats)
+      self.assertEqual(['Potato'], kitchen.gettable_ingredients)
+      self.assertEqual(['ingredients'], list(kitchen.load_stats))
+      food = interactive.Food(Mixture("Potato"), kitchen=kitchen)
+      food.apply_action_from_attribute('slice')
+      food.apply_action_from_attribute('slice')
+      self.assertEqual("(diced Potato)", str(food.mixture))
+      self.assertEqual("Pot containing (Fries)", str(food))
+
+  def test_actions_after_removal(self):
+    with tempfile.TemporaryDirectory() as directory:
+      kitchen = self.make_kitchen(directory)
+      food = interactive.Food(Mixture("(Potato) + (Potato)"), kitchen=kitchen)
+      first, second = food.mixture.components
+      food.apply_action_to_component(second, 'drain')
+      self.assertEqual([first], food.mixture.components) # the very component that was drained is gone
+      self.assertIs(first, food.mixture.components[0])
+      self.assertEqual("(drained Potato)", str(Mixture(food.marked_for_separating_out)))
+      with self.assertRaisesRegex(Exception, "no longer in the mixture"):
+        food.apply_action_to_component(food.mixture.components[0], 'vanish')
+
+  def test_foods_do_not_change_reductions(self):
+    with tempfile.TemporaryDirectory() as directory:
+      kitchen = self.make_kitchen(directory)
+      for cache_size in [None, 16]:
+        kitchen.rs.disable_cache()
+        if cache_size:
+          kitchen.rs.enable_cache(cache_size)
+        reduced = kitchen.rs.reduce_mixture(Mixture("chopped Potato")) # the very input, or from the cache
+        food = interactive.Food(reduced, kitchen=kitchen)
+        food.apply_action_from_attribute('slice')
+        self.assertEqual("(diced Potato)", str(food.mixture))
+        self.assertEqual("(chopped Potato)", str(reduced))
+        self.assertEqual("(chopped Potato)", str(kitchen.rs.reduce_mixture(Mixture("chopped Potato"))))
+
+
+class TestSimulator(unittest.TestCase):
+
+  def test_sessions_are_reproducible(self):
+    outcomes = list(simulator.simulate(3, seed=5, processes=1))
+    self.assertEqual([5,6,7], [o['seed'] for o in outcomes])
+    self.assertEqual([None]*3, [o['error'] for o in outcomes])
+    self.assertTrue(all(o['actions'] and o['foods'] for o in outcomes))
+    again = simulator.run_session(6)
+    self.assertEqual((outcomes[1]['actions'], outcomes[1]['foods']), (again['actions'], again['foods']))
+
+
+class TestServer(unittest.TestCase):
+
+  def test_sessions_and_reduction(self):
+    kitchen = interactive.default_kitchen()
+    async def run(path):
+      server = server_module.KitchenServer(workers=1, executor='thread', batch_delay=0.01, kitchen_kwargs={'cache_dir' : cache_dir.name})
+      await server.start(unix_path=path)
+      client = await server_module.KitchenClient().connect(unix_path=path)
+      session = (await client.request('new_session'))['session']
+      await client.request('get', session=session, arg='Potato')
+      cut, reduced = await asyncio.gather(
+        client.request('cut', session=session, arg='0'),
+        asyncio.gather(*[client.request('reduce_mixture', mixture="(sliced Potato) + (Water)") for _ in range(5)]),
+      )
+      with self.assertRaises(Exception):
+        await client.request('cut', session='nonexistent', arg='0')
+      stats = await client.request('stats')
+      await client.close()
+      await server.close()
+      return cut, reduced, stats
+    with tempfile.TemporaryDirectory() as directory:
+      cut, reduced, stats = asyncio.run(run(os.path.join(directory, 'socket')))
+    food = interactive.Food(Mixture("Potato"), kitchen=kitchen)
+    food.apply_action_from_attribute('slice')
+    self.assertEqual([str(food.mixture)], [f['mixture'] for f in cut['foods']])
+    self.assertEqual([str(kitchen.reduce_mixture(False, Mixture("(sliced Potato) + (Water)")))]*5, [r['mixture'] for r in reduced])
+    self.assertEqual(5, stats['reduced'])
+    self.assertLessEqual(stats['batches'], stats['reduced'])
+
+
+class TestClosureTable(unittest.TestCase):
+
+  def test_lookup(self):
+    records = {'R|(chopped Potato)' : '(Fries)', 'D|(Fries)' : '(Tasty Fries)', 'R|(Potato) + (Water)' : '(Soup)'}
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'table.bin')
+      closure_table.write_table(path, records, b'x'*32)
+      table = closure_table.ClosureTable(path, b'x'*32)
+      self.assertEqual(3, len(table))
+      for key, value in records.items():
+        self.assertEqual(value, table.get(key))
+      self.assertIsNone(table.get('R|(Potato)'))
+      self.assertEqual(Mixture("(Soup)"), table.lookup('R', Mixture("(Potato) + (Water)")))
+      table.close()
+      with self.assertRaises(Exception):
+        closure_table.ClosureTable(path, b'y'*32)
+
+  def test_fingerprint(self):
+    fingerprint = closure_table.data_fingerprint()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+      os.chdir(directory)
+      try:
+        self.assertEqual(fingerprint, closure_table.data_fingerprint())
+        with self.assertRaises(Exception):
+          closure_table.data_fingerprint(['reductions'])
+        with open('reductions', 'w') as f:
+          f.write("a i1 -> b i1\n")
+        self.assertNotEqual(closure_table.data_fingerprint(['reductions']), closure_table.data_fingerprint(closure_table.DATA_PATHS[:1]))
+      finally:
+        os.chdir(cwd)
+
+
 class TestComponentRuleLHS(unittest.TestCase):
 
   def test_parsing(self):
@@ -53,48 +324,60 @@ class TestTypechecker(unittest.TestCase):
     for token in examples_last:
       self.assertEqual(examples_last[token] , type_checker.type_info(token,last=True))
 
+  def test_qualifier_cache(self):
+    type_checker = TrivialTypeChecker()
+    token = type_checker.parse_token("salty")
+    qualifier = condition_syntax_tree.Cst("salty_tag&!soggy_tag")
+    self.assertTrue(type_checker.const_satisfies_qualifier(token, qualifier))
+    self.assertTrue(type_checker.const_satisfies_qualifier(token, qualifier))
+    self.assertFalse(type_checker.const_satisfies_qualifier(type_checker.parse_token("soggy"), qualifier))
+    info = type_checker.qualifier_cache_info()
+    self.assertEqual((1,2), (info['hits'], info['misses']))
+
 
 class TestPatternMatch(unittest.TestCase):
 
+  # pattern, target, expected match
+  examples = [
+    ("m1 i1", "salty AnIngredient",
+        {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': []} ),
+    ("m1 i1:AnIngredient_tag", "salty AnIngredient",
+        {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': []} ),
+    ("m1:salty_tag i1", "soggy salty crappy AnIngredient",
+        {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': ['soggy','crappy']} ),
+    ("o3 m1:salty_tag i1", "soggy salty crappy AnIngredient",
+        {'m1': 'salty', 'i1': 'AnIngredient', 'o3': ['soggy','crappy']} ),
+    ("& m1:salty_tag i1", "soggy salty crappy AnIngredient",
+        {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': ['soggy','crappy']} ),
+    ("&& m1:salty_tag i1", "soggy salty crappy AnIngredient",
+        None ),
+    ("&& m1 i1", "soggy salty crappy AnIngredient",
+        {'m1':'crappy' , 'i1': 'AnIngredient', 'o_auto': ['soggy','salty']} ),
+    ("o5:salty_tag && m1 i1", "soggy salty crappy AnIngredient",
+        {'m1':'crappy' , 'i1': 'AnIngredient', 'o5': ['salty']} ),
+    ("o5:salty_tag && m1 m1 i1", "soggy salty crappy AnIngredient",
+        None ),
+    ("o5 && m1 m1 i1", "soggy salty salty AnIngredient",
+        {'m1':'salty' , 'i1': 'AnIngredient', 'o5': ['soggy']} ),
+    ("o5 && m1 m2 m1 i1", "soggy salty salty AnIngredient",
+        None ),
+    ("o5 m1 m2 m1 i1", "soggy salty salty AnIngredient",
+        {'m1':'salty' , 'm2':'soggy', 'i1': 'AnIngredient', 'o5': []} ),
+    ("o5 & soggy salty i1", "soggy salty salty AnIngredient",
+        {'i1': 'AnIngredient', 'o5': ['salty']} ),
+    ("o5 & salty soggy i1", "soggy salty salty AnIngredient",
+        None ),
+    ("o5 & salty soggy i1 !! neupy", "salty soggy peupy AnIngredient",
+        {'i1':'AnIngredient', 'o5':['peupy']} ),
+    ("o5 & salty soggy i1 !! peupy", "salty soggy peupy AnIngredient",
+        None ),
+    ("o1 && salty crappy i1", "soggy salty peupy salty crappy AnIngredient",
+        {'i1':'AnIngredient', 'o1':['soggy','salty','peupy']} ),
+  ]
+
   def test_match_component_pattern(self):
     type_checker = TrivialTypeChecker()
-
-    # pattern, target, expected match
-    examples = [
-      ("m1 i1", "salty AnIngredient",
-          {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': []} ),
-      ("m1 i1:AnIngredient_tag", "salty AnIngredient",
-          {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': []} ),
-      ("m1:salty_tag i1", "soggy salty crappy AnIngredient",
-          {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': ['soggy','crappy']} ),
-      ("o3 m1:salty_tag i1", "soggy salty crappy AnIngredient",
-          {'m1': 'salty', 'i1': 'AnIngredient', 'o3': ['soggy','crappy']} ),
-      ("& m1:salty_tag i1", "soggy salty crappy AnIngredient",
-          {'m1': 'salty', 'i1': 'AnIngredient', 'o_auto': ['soggy','crappy']} ),
-      ("&& m1:salty_tag i1", "soggy salty crappy AnIngredient",
-          None ),
-      ("&& m1 i1", "soggy salty crappy AnIngredient",
-          {'m1':'crappy' , 'i1': 'AnIngredient', 'o_auto': ['soggy','salty']} ),
-      ("o5:salty_tag && m1 i1", "soggy salty crappy AnIngredient",
-          {'m1':'crappy' , 'i1': 'AnIngredient', 'o5': ['salty']} ),
-      ("o5:salty_tag && m1 m1 i1", "soggy salty crappy AnIngredient",
-          None ),
-      ("o5 && m1 m1 i1", "soggy salty salty AnIngredient",
-          {'m1':'salty' , 'i1': 'AnIngredient', 'o5': ['soggy']} ),
-      ("o5 && m1 m2 m1 i1", "soggy salty salty AnIngredient",
-          None ),
-      ("o5 m1 m2 m1 i1", "soggy salty salty AnIngredient",
-          {'m1':'salty' , 'm2':'soggy', 'i1': 'AnIngredient', 'o5': []} ),
-      ("o5 & soggy salty i1", "soggy salty salty AnIngredient",
-          {'i1': 'AnIngredient', 'o5': ['salty']} ),
-      ("o5 & salty soggy i1", "soggy salty salty AnIngredient",
-          None ),
-      ("o5 & salty soggy i1 !! neupy", "salty soggy peupy AnIngredient",
-          {'i1':'AnIngredient', 'o5':['peupy']} ),
-      ("o5 & salty soggy i1 !! peupy", "salty soggy peupy AnIngredient",
-          None ),
-    ]
-    for pattern, target, expected in examples:
+    for pattern, target, expected in self.examples:
       match = match_component_pattern(
         ComponentRuleLHS(pattern),
         Component(target),
@@ -102,6 +385,42 @@ class TestPatternMatch(unittest.TestCase):
       )
       self.assertEqual(expected,match)
 
+  def test_compiled_pattern(self):
+    type_checker = TrivialTypeChecker()
+    lhs = ComponentRuleLHS("o1 & m1:salty_tag i1 !! soggy i1")
+    compiled = lhs.compile(type_checker)
+    self.assertIs(compiled, lhs.compile(type_checker))
+    self.assertIsNot(compiled, lhs.compile(TrivialTypeChecker()))
+    self.assertEqual(
+      {'m1': 'salty', 'i1': 'AnIngredient', 'o1': ['crappy']},
+      match_component_pattern(compiled, Component("salty crappy AnIngredient"), type_checker)
+    )
+    self.assertIsNone(match_component_pattern(compiled, Component("soggy salty AnIngredient"), type_checker))
+
+  def test_generated_matcher(self):
+    rules = [ReductionRuleComponent(pattern, 'Potato') for pattern,_,_ in self.examples]
+    with tempfile.TemporaryDirectory() as cache_dir:
+      parse_reductions.compile_rules(rules, cache_dir=cache_dir, verify=True)
+      self.assertEqual(1, len(os.listdir(cache_dir)))
+    for rule, (pattern, target, expected) in zip(rules, self.examples):
+      self.assertIsNotNone(rule.compiled_lhs.generated_matcher)
+      self.assertEqual(expected, rule.match_lhs(Component(target)))
+    parse_reductions.decompile_rules(rules)
+    self.assertIsNone(rules[0].compiled_lhs.generated_matcher)
+
+  def test_generated_matcher_uses_type_checker(self):
+    class InvertingTypeChecker(TrivialTypeChecker):
+      def const_satisfies_qualifier(self, const_token, cst):
+        return not super().const_satisfies_qualifier(const_token, cst)
+    type_checker = InvertingTypeChecker()
+    interpreted = [ReductionRuleComponent(pattern, 'Potato', type_checker) for pattern,_,_ in self.examples]
+    generated = [ReductionRuleComponent(pattern, 'Potato', type_checker) for pattern,_,_ in self.examples]
+    with tempfile.TemporaryDirectory() as cache_dir:
+      parse_reductions.compile_rules(generated, cache_dir=cache_dir)
+    for interpreted_rule, generated_rule, (_, target, _) in zip(interpreted, generated, self.examples):
+      self.assertEqual(interpreted_rule.match_lhs(Component(target)), generated_rule.match_lhs(Component(target)))
+    self.assertIsNone(generated[1].match_lhs(Component("salty AnIngredient"))) # the override is not bypassed
+
 
 
 
@@ -118,6 +437,15 @@ class TestReductionRuleComponent(unittest.TestCase):
   def test_apply(self):
     self.assertEqual(str(self.reduced_component), str(self.rrc.apply(self.component)))
 
+  def test_apply_reports_no_change(self):
+    self.assertIs(self.reduced_component, self.rrc.apply(self.reduced_component))
+    identity_rule = ReductionRuleComponent('m1 i1','m1 i1')
+    component = Component("salty AnIngredient")
+    self.assertIs(component, identity_rule.apply(component))
+    mixture = Mixture([self.reduced_component, Component("Potato")])
+    self.assertIs(mixture, ReductionRuleComponentAsMixture(self.rrc).apply(mixture))
+    self.assertIsNot(mixture, ReductionRuleComponentAsMixture(self.rrc).apply(Mixture([self.component])))
+
 
 
 class TestReductionRuleMixture(unittest.TestCase):
@@ -138,6 +466,37 @@ class TestReductionRuleMixture(unittest.TestCase):
       str(self.rrm.apply(Mixture("(Apple AnIngredient) + (powdered AnotherIngredient)")))
     )
 
+  def test_match_memo(self):
+    mixture = Mixture("(powdered AnotherIngredient) + (Apple AnIngredient) + (fried Potato)")
+    self.assertEqual("(Apple AnotherIngredient Dough) + (fried Potato)", str(self.rrm.apply(mixture)))
+    mixture = Mixture(mixture.components[:2] + [Component("boiled Potato")])
+    self.assertEqual(
+      "(Apple AnotherIngredient Dough) + (boiled Potato)",
+      str(self.rrm.apply(mixture))
+    )
+    self.assertEqual(
+      match_mixture_pattern(self.rrm.compiled_lhs, mixture.components, self.rrm.type_checker),
+      self.rrm.match_lhs(mixture)
+    )
+    for info in self.rrm.match_memo_info(): # no component was matched twice against the same pattern
+      self.assertEqual(info['size'], info['misses'])
+
+  def test_shared_variable_join(self):
+    rrm = ReductionRuleMixture("(o1 i1) + (o2 i1) + (o3 i2)","(o1 o2 i1) + (o3 i2)")
+    self.assertEqual(
+      "(salty zesty AnotherIngredient) + (AnIngredient)",
+      str(rrm.apply(Mixture("(AnIngredient) + (salty AnotherIngredient) + (zesty AnotherIngredient)")))
+    )
+    self.assertIsNone(rrm.match_lhs(Mixture("(AnIngredient) + (salty AnotherIngredient) + (Potato)")))
+
+  def test_match_matrix(self):
+    mixture = Mixture("(fried Potato) + (powdered AnotherIngredient) + (Apple AnIngredient)")
+    self.rrm.match_lhs(mixture)
+    # every pattern is matched against every component once, before the join
+    self.assertEqual([3,3], [info['misses'] for info in self.rrm.match_memo_info()])
+    self.assertEqual(({'o1':['Apple'], 'o2':[], 'i7':'AnotherIngredient'}, [mixture.components[0]]), self.rrm.match_lhs(mixture))
+    self.assertEqual([3,3], [info['hits'] for info in self.rrm.match_memo_info()])
+
   def test_apply2(self):
     self.assertEqual(
       "(Apple AnotherIngredient Dough) + (fried Potato)",
@@ -175,7 +534,211 @@ class TestReductionSystem(unittest.TestCase):
     reduced = rs.reduce_mixture(Mixture("(crushed dried Oat) + (Apple Water) + Oil"))
     self.assertEqual("(oily Apple Oat Dough)",str(reduced))
 
+  def test_component_reduction_needs_several_passes(self):
+    crules = [parse_reductions.parse_component_reduction_rule("b i1 -> c i1")]
+    crules.append( parse_reductions.parse_component_reduction_rule("a i1 -> b i1") )
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(c) for c in crules])
+    self.assertEqual("c AnIngredient",str(rs.reduce_component(Component("a AnIngredient"))))
+
+  def test_agenda_engine(self):
+    rules = [
+      parse_reductions.parse_mixture_reduction_rule("(o1 powdered i1:Grain) + (o2 Water) -> (o1 o2 i1 Dough)"),
+      parse_reductions.parse_mixture_reduction_rule("(o1 Oil) + (o2 i1)-> (o1 o2 oily i1)"),
+      ReductionRuleComponentAsMixture(parse_reductions.parse_component_reduction_rule("& crushed dried i1 -> powdered i1")),
+      ReductionRuleComponentAsMixture(parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")),
+    ]
+    fixpoint = ReductionSystem(rules)
+    agenda = ReductionSystem(rules, engine='agenda')
+    for rs in [fixpoint, agenda]:
+      rs.set_type_checker(TestTypeChecker())
+    for mixture_str in ["(crushed dried Oat) + (Apple Water) + Oil", "(happy sad Oat) + (sad Water)", "(dried Oat) + (Oil)"]:
+      self.assertEqual(str(fixpoint.reduce_mixture(Mixture(mixture_str))), str(agenda.reduce_mixture(Mixture(mixture_str))))
+    self.assertGreater(agenda.agenda_stats['saved'], 0)
+    self.assertRaises(Exception, ReductionSystem, rules, engine='peupy')
+    # The first rule only moves its match to the front, so once the second rule puts a component in front
+    # it applies again, even though that component has nothing it could match
+    rules = [
+      parse_reductions.parse_mixture_reduction_rule("(o1 Oil) + (o2 Water) -> (o1 Oil) + (o2 Water)"),
+      parse_reductions.parse_mixture_reduction_rule("(o1 Oat) + (o2 Oat) -> (o1 o2 Oat)"),
+    ]
+    for engine in ReductionSystem.engines:
+      rs = ReductionSystem(rules, engine=engine)
+      rs.set_type_checker(TestTypeChecker())
+      self.assertEqual("(Oil) + (Water) + (Oat)", str(rs.reduce_mixture(Mixture("(Oil) + (Water) + (Oat) + (Oat)"))))
+
+  def test_normal_form_cache(self):
+    crules = [parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")]
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(c) for c in crules], cache_size=16)
+    mixture = Mixture("(happy sad AnIngredient) + (sad AnIngredient)")
+    self.assertEqual("(neutral AnIngredient) + (sad AnIngredient)", str(rs.reduce_mixture(mixture)))
+    reduced = rs.reduce_mixture(Mixture("(happy sad AnIngredient) + (sad AnIngredient)"))
+    self.assertEqual("(neutral AnIngredient) + (sad AnIngredient)", str(reduced))
+    self.assertEqual(1, rs.cache_info()['hits'])
+    self.assertIsNot(reduced.components, rs.reduce_mixture(mixture).components) # each caller gets its own mixture
+    self.assertEqual("neutral AnIngredient", str(rs.reduce_component(Component("happy sad AnIngredient"))))
+    rs.rules = [ReductionRuleComponentAsMixture(parse_reductions.parse_component_reduction_rule("happy sad i1 -> manic i1"))]
+    self.assertEqual(0, rs.cache_info()['size'])
+    self.assertEqual("(manic AnIngredient) + (sad AnIngredient)", str(rs.reduce_mixture(mixture)))
+    self.assertEqual(hash(mixture), hash(Mixture("(happy sad AnIngredient) + (sad AnIngredient)")))
+
+  def test_rule_index(self):
+    type_checker = TestTypeChecker()
+    rules = [
+      parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1"),
+      parse_reductions.parse_component_reduction_rule("m1 i1:Grain -> i1"),
+      parse_reductions.parse_component_reduction_rule("m1 m1 i1 -> m1 i1"),
+    ]
+    for rule in rules:
+      rule.set_type_checker(type_checker)
+    self.assertEqual(['happy','Grain',None], [pattern_anchor(r.lhs.compile(type_checker)) for r in rules])
+    mrule = parse_reductions.parse_mixture_reduction_rule("(o1 powdered i1:Grain) + (o2 Water) -> (o1 o2 i1 Dough)")
+    mrule.set_type_checker(type_checker)
+    index = RuleIndex([ReductionRuleComponentAsMixture(r) for r in rules]+[mrule], type_checker)
+    self.assertEqual({rules[0],rules[2]}, index.candidates(Component("sad happy Water")))
+    self.assertEqual({rules[1],rules[2]}, index.candidates(Component("sad Oat")))
+    self.assertTrue(index.may_match_mixture(mrule, Mixture("(powdered Oat) + (Water)")))
+    self.assertFalse(index.may_match_mixture(mrule, Mixture("(Oat) + (Water)")))
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(r) for r in rules]+[mrule])
+    rs.set_type_checker(type_checker)
+    self.assertIs(type_checker, rs.rule_index.type_checker) # built when the rules are loaded, not on first use
+    self.assertEqual({rules[1],rules[2]}, rs.rule_index.candidates(Component("sad Oat")))
+
+  def test_reduce_many(self):
+    crules = [parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")]
+    crules.append( parse_reductions.parse_component_reduction_rule("a i1 -> a a i1") )
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(r) for r in crules])
+    rs.set_type_checker(TestTypeChecker())
+    rs.max_iterations = 10
+    mixtures = [Mixture("(sad happy Oat)"), Mixture("(a Oat)"), Mixture("(Water) + (happy sad Water)")]*5
+    for executor in ['serial', 'thread', 'process']:
+      results = list(rs.reduce_many(mixtures, executor, workers=2, chunk_size=2))
+      self.assertEqual(["(neutral Oat)", None, "(Water) + (neutral Water)"]*5, [r and str(r) for r,_ in results])
+      self.assertEqual([False, True, False]*5, [e is not None for _,e in results])
+      self.assertIn("Timed out", str(results[1][1]))
+
+  def test_reduce_many_threads(self):
+    rules = [
+      parse_reductions.parse_mixture_reduction_rule("(o1 powdered i1:Grain) + (o2 Water) -> (o1 o2 i1 Dough)"),
+      parse_reductions.parse_mixture_reduction_rule("(o1 Oil) + (o2 i1)-> (o1 o2 oily i1)"),
+      ReductionRuleComponentAsMixture(parse_reductions.parse_component_reduction_rule("& crushed dried i1 -> powdered i1")),
+      ReductionRuleComponentAsMixture(parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")),
+    ]
+    rs = ReductionSystem(rules, cache_size=8, engine='agenda')
+    rs.set_type_checker(TestTypeChecker())
+    mixture_strs = ["(crushed dried Oat) + (Apple Water) + Oil", "(happy sad Oat) + (sad Water)", "(dried Oat) + (Oil)"]
+    mixture_strs += ["(happy sad {}) + (crushed dried Oat) + (Water)".format(i) for i in ["Apple", "Oat", "Water"]]
+    mixtures = [Mixture(mixture_strs[i*i % len(mixture_strs)]) for i in range(400)]
+    serial = [(str(r), str(e)) for r,e in rs.reduce_many(mixtures, 'serial')]
+    cache_info, agenda_stats = rs.cache_info(), dict(rs.agenda_stats)
+    threaded = [(str(r), str(e)) for r,e in rs.reduce_many(mixtures, 'thread', workers=8, chunk_size=4)]
+    self.assertEqual(serial, threaded)
+    self.assertEqual((cache_info, agenda_stats), (rs.cache_info(), rs.agenda_stats)) # each thread has its own copy
+
+  def test_profiling(self):
+    crules = [parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")]
+    crules.append( parse_reductions.parse_component_reduction_rule("neutral neutral i1 -> neutral i1") )
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(r) for r in crules])
+    rs.set_type_checker(TestTypeChecker())
+    rs.enable_profiling()
+    rs.reduce_mixture(Mixture("(happy sad neutral Oat) + (Water)"))
+    data = {entry['rule'] : entry for entry in rs.profile_data()}
+    self.assertEqual((1,1), (data["happy sad i1 -> neutral i1"]['matches'], data["happy sad i1 -> neutral i1"]['rewrites']))
+    self.assertEqual(1, data["neutral neutral i1 -> neutral i1"]['rewrites'])
+    self.assertGreater(data["neutral neutral i1 -> neutral i1"]['iterations'], 1)
+    self.assertIn("happy sad i1 -> neutral i1", rs.profile_report())
+    rs.disable_profiling()
+    self.assertEqual([], rs.profile_data())
+
+  def test_trace(self):
+    crules = [parse_reductions.parse_component_reduction_rule("happy sad i1 -> neutral i1")]
+    crules.append( parse_reductions.parse_component_reduction_rule("neutral neutral i1 -> neutral i1") )
+    crules.append( parse_reductions.parse_component_reduction_rule("a i1 -> a a i1") )
+    rs = ReductionSystem([ReductionRuleComponentAsMixture(r) for r in crules])
+    rs.set_type_checker(TestTypeChecker())
+    rs.max_iterations = 10
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'trace.jsonl')
+      trace = rs.enable_trace(capacity=4, failure_path=path)
+      rs.reduce_mixture(Mixture("(happy sad neutral Oat) + (Water)"))
+      self.assertEqual([
+          {'seq':1, 'rule':"happy sad i1 -> neutral i1", 'before':"(happy sad neutral Oat) + (Water)", 'after':"(neutral neutral Oat) + (Water)"},
+          {'seq':2, 'rule':"neutral neutral i1 -> neutral i1", 'before':"(neutral neutral Oat) + (Water)", 'after':"(neutral Oat) + (Water)"},
+        ],
+        list(trace.events())
+      )
+      self.assertEqual(list(trace.events()), rs.last_trace())
+      rs.reduce_mixture(Mixture("(happy sad Oat)"))
+      self.assertEqual([("happy sad i1 -> neutral i1", "(happy sad Oat)")], [(e['rule'], e['before']) for e in rs.last_trace()])
+      self.assertEqual(3, len(trace))
+      with self.assertRaises(Exception):
+        rs.reduce_mixture(Mixture("(a Oat)"))
+      self.assertEqual(4, len(trace))
+      self.assertEqual(["a i1 -> a a i1"], [e['rule'] for e in trace.events(last=1)])
+      with open(path) as f:
+        lines = f.read().splitlines()
+    self.assertEqual(5, len(lines))
+    self.assertIn('"failed": "(a Oat)"', lines[0])
+
+  def test_parse_cache(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'reductions')
+      with open(path, 'w') as f:
+        f.write("Sad: sad, mad\n(o1 powdered i1:Grain) + (o2 Water) -> (o1 o2 i1 Dough)\nm1:Sad i1 -> neutral i1\n")
+      cache_dir = os.path.join(directory, 'cache')
+      rules, modifier_tags = parse_reductions.parse(path, cache_dir)
+      self.assertEqual(1, len(os.listdir(cache_dir)))
+      cached_rules, cached_modifier_tags = parse_reductions.parse(path, cache_dir)
+    self.assertIsNot(rules[0], cached_rules[0])
+    self.assertEqual([str(r) for r in rules], [str(r) for r in cached_rules])
+    self.assertEqual({'sad':['Sad'], 'mad':['Sad']}, cached_modifier_tags)
+    rs = ReductionSystem(cached_rules)
+    rs.set_type_checker(TestTypeChecker())
+    self.assertEqual(
+      "(Oat Dough)",
+      str(rs.reduce_mixture(Mixture("(powdered Oat) + (Water)")))
+    )
 
+  def test_cycle_detection(self):
+    rules, _ = parse_reductions.parse_text("o1 c i1 -> o1 a i1\no1 b i1 -> o1 c i1\no1 a i1 -> o1 b i1\n")
+    for engine in ReductionSystem.engines:
+      rs = ReductionSystem(rules, engine=engine)
+      rs.set_type_checker(TestTypeChecker())
+      with self.assertRaises(ReductionCycleError) as context:
+        rs.reduce_mixture(Mixture("(a Oat) + (Water)"))
+      self.assertIn("Timed out", str(context.exception))
+      self.assertEqual(["(b Oat) + (Water)", "(c Oat) + (Water)"], [str(m) for m in context.exception.states])
+      self.assertEqual([[str(rules[1])], [str(rules[0]), str(rules[2])]], [list(map(str,r)) for r in context.exception.rules])
+
+  def test_cycle_replay_is_not_counted(self):
+    class NoReplayReductionSystem(ReductionSystem):
+      def apply_till_no_change(self, f, x, debug=False):
+        return apply_till_no_change(f, x, self.max_iterations, debug)
+    counters = []
+    for system_class in [ReductionSystem, NoReplayReductionSystem]:
+      rules, _ = parse_reductions.parse_text("o1 c i1 -> o1 a i1\no1 b i1 -> o1 c i1\no1 a i1 -> o1 b i1\n")
+      rs = system_class(rules, engine='agenda')
+      rs.set_type_checker(TestTypeChecker())
+      rs.enable_profiling()
+      with self.assertRaises(ReductionCycleError):
+        rs.reduce_mixture(Mixture("(a Oat) + (Water)"))
+      profile = [(e['rule'], e['attempts'], e['matches'], e['rewrites'], e['iterations']) for e in rs.profile_data()]
+      counters.append((dict(rs.agenda_stats), sorted(profile)))
+    self.assertEqual(counters[1], counters[0])
+
+  def test_rule_analysis(self):
+    rules, _ = parse_reductions.parse_text(
+      "o1 powdered i1:Grain -> o1 Dough\n"
+      "o1 powdered Oat -> o1 Oat\n"
+      "o1 i1:Fruit -> o1 Juice\n"
+      "o1 powdered i1 -> o1 i1\n"
+      "(o1 i1:Fruit) + (o2 Water) -> (o1 o2 i1 Juice)\n"
+    )
+    rs = ReductionSystem(rules)
+    rs.set_type_checker(TestTypeChecker())
+    findings = parse_reductions.analyze_rules(rs.rules, rs.type_checker, ["Oat", "Water", "Oil", "Dough"], [], warn=False)
+    self.assertEqual([rules[1], rules[2], rules[4]], [rule for rule,_ in findings])
+    self.assertIn("shadowed", findings[0][1])
+    self.assertIn("nothing matches i1:Fruit", findings[1][1])
 
 
 if __name__ == '__main__':
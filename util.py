@@ -1,6 +1,10 @@
-import copy
+import bisect
 from component import *
 from mixture import *
+from cache import LRUCache, MISSING
+import os, json, random, pickle, itertools, functools, threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 class Ingredient:
   """ Represents a NON_ABSTRACT ingredient. Any "ingredient inheritance" should be already resolved.
@@ -20,13 +24,52 @@ class Ingredient:
 
 
 
-def apply_till_no_change(f,x,max_iterations,debug=False):
-  """Apply f repeatedly to x and return the result if it converges. Raise Exception otherwise."""
-  old_x=copy.deepcopy(x)
+class ReductionCycleError(Exception):
+  """ Raised by apply_till_no_change when a state comes back, which means that reducing would go on forever.
+  |states| is the cycle of states, where each one is rewritten into the next and the last into the first,
+  and rules[i] is the list of rules that rewrote states[i], or None if it is not known.
+  A ReductionSystem fills in unknown rules by replaying the cycle, see ReductionSystem.apply_till_no_change.
+  """
+  def __init__(self, start, states, rules):
+    super().__init__(start, states, rules)
+    self.start = start
+    self.states = states
+    self.rules = rules
+
+  def __str__(self):
+    lines = ["Timed out while reducing '{}'. Was stuck at '{}'.\n\
+    \t Is there a cycle in your reduction system?".format(self.start, self.states[0])]
+    lines.append("Cycle of {} states:".format(len(self.states)))
+    for state, rules in zip(self.states, self.rules):
+      lines.append("  {}".format(state))
+      if rules is not None:
+        lines.extend("    by {}".format(rule) for rule in rules)
+    return '\n'.join(lines)
+
+
+def apply_till_no_change(f,x,max_iterations,debug=False,rule=None):
+  """Apply f repeatedly to x and return the result if it converges. Raise Exception otherwise.
+  f reports that it changed nothing by returning its argument itself, and it must not modify its argument.
+  (The apply methods of reduction rules work this way.) Only when f reports a change is the result
+  compared with its argument, since a sequence of rewrites can lead back to where it started.
+  The keys of the states seen are kept, so that a cycle raises a ReductionCycleError as soon as a state
+  comes back, naming |rule| as the rule of each step if it is given. Otherwise an Exception is raised
+  after |max_iterations| changes, which only happens if the states keep on being new."""
+  old_x=x
+  seen = None # maps keys of the states seen so far to their positions in states
   for _ in range(max_iterations):
     new_x = f(old_x, debug)
-    if new_x == old_x:
+    if new_x is old_x or new_x == old_x:
       return new_x
+    if seen is None:
+      states = [old_x]
+      seen = {old_x.key() : 0}
+    key = new_x.key()
+    if key in seen:
+      cycle = states[seen[key]:]
+      raise ReductionCycleError(x, cycle, [[rule] if rule is not None else None for _ in cycle])
+    seen[key] = len(states)
+    states.append(new_x)
     old_x = new_x
   raise Exception("Timed out while reducing '{}'. Was stuck at '{}'.\n\
     \t Is there a cycle in your reduction system?".format(x,new_x))
@@ -36,36 +79,420 @@ def apply_each_rule_till_no_change(rules, x, max_iterations, debug=False):
   """For each rule in rules, apply it to x until convergence.
      Here a rule just has to have an apply method,
      so it could be a component rule (in which case x must be a Component)
-     or a mixture rule (in which case x must be a Mixture)"""
-  y = copy.deepcopy(x)
+     or a mixture rule (in which case x must be a Mixture)
+     Returns x itself if no rule changed it."""
+  y = x
   for rule in rules:
-    y = apply_till_no_change(rule.apply,y,max_iterations, debug)
+    y = apply_till_no_change(rule.apply,y,max_iterations, debug, rule)
   return y
 
 
 
+def pattern_anchor(compiled_lhs):
+  """ Given a CompiledComponentRuleLHS, return a key that every Component it matches must have
+  among its component_keys, or None if there is no such key.
+  Constant tokens are preferred as anchors (the base ingredient first), then required qualifier tags.
+  """
+  tokens = compiled_lhs.tokens
+  ordered_tokens = tokens[-1:] + tokens[:-1]
+  for token in ordered_tokens:
+    if token.varness=='const':
+      return token.name
+  for token in ordered_tokens:
+    if token.varness=='qvar':
+      required = token.qualifier.required_symbols()
+      if required:
+        return min(required)
+  return None
+
+
+def component_keys(component, type_checker):
+  'Return the set of names and tags of the tokens of a constant Component, see pattern_anchor'
+  keys = set()
+  for token in type_checker.parse_component(component):
+    keys.add(token.name)
+    keys.update(type_checker.tags_of_const(token))
+  return keys
+
+
+class RuleIndex:
+  """ Discrimination index for the rules of a ReductionSystem.
+  Each component rule is filed under its pattern_anchor: a constant or tag that
+  a Component must have for the rule to possibly match it. Rules without an anchor
+  are candidates for every Component. Mixture rules are filed under the anchors of their
+  component patterns, all of which must show up in the mixture.
+  Only rules using |type_checker| get anchors, since tags depend on the type checker.
+  """
+  def __init__(self, rules, type_checker, cache_size=4096):
+    self.type_checker = type_checker
+    self.rules_by_key = {} # maps anchors to lists of ReductionRuleComponent
+    self.unanchored = [] # ReductionRuleComponents with no anchor
+    self.mixture_anchors = {} # maps ReductionRuleMixtures to lists of anchors
+    for rule in rules:
+      if isinstance(rule, ReductionRuleComponentAsMixture):
+        component_rule = rule.component_rule
+        anchor = None
+        if component_rule.type_checker is type_checker:
+          anchor = pattern_anchor(component_rule.lhs.compile(type_checker))
+        if anchor is None:
+          self.unanchored.append(component_rule)
+        else:
+          self.rules_by_key.setdefault(anchor,[]).append(component_rule)
+      elif isinstance(rule, ReductionRuleMixture) and rule.type_checker is type_checker:
+        anchors = [pattern_anchor(c.compile(type_checker)) for c in rule.lhs.components]
+        self.mixture_anchors[rule] = [a for a in anchors if a is not None]
+    self.keys_cache = LRUCache(cache_size)
+    self.candidates_cache = LRUCache(cache_size)
+
+  def keys_of(self, component):
+    'Return component_keys of |component|, cached by its ids'
+    keys = self.keys_cache.get(component.ids)
+    if keys is MISSING:
+      keys = frozenset(component_keys(component, self.type_checker))
+      self.keys_cache.put(component.ids, keys)
+    return keys
+
+  def candidates(self, component):
+    'Return the frozenset of ReductionRuleComponents that could match |component|'
+    candidates = self.candidates_cache.get(component.ids)
+    if candidates is MISSING:
+      candidate_list = list(self.unanchored)
+      for key in self.keys_of(component):
+        candidate_list += self.rules_by_key.get(key,[])
+      candidates = frozenset(candidate_list)
+      self.candidates_cache.put(component.ids, candidates)
+    return candidates
+
+  def may_match_mixture(self, rule, mixture):
+    'Return False if the ReductionRuleMixture |rule| certainly does not match |mixture|'
+    anchors = self.mixture_anchors.get(rule)
+    if not anchors:
+      return True
+    keys = set()
+    for component in mixture.components:
+      keys.update(self.keys_of(component))
+    return all(anchor in keys for anchor in anchors)
+
+  def may_match_with(self, rule, components):
+    """ Return False if the ReductionRuleMixture |rule|, which matched nothing in some mixture, certainly
+    still matches nothing after the Components |components| came into it. A new match would have to use
+    one of them, so one of them would need the anchor of one of the component patterns.
+    """
+    anchors = self.mixture_anchors.get(rule)
+    if anchors is None or len(anchors) < len(rule.lhs.components):
+      return bool(components)
+    return any(anchor in self.keys_of(component) for component in components for anchor in anchors)
+
+
+
+class ReductionTrace:
+  """ A bounded record of the rewrites done by a ReductionSystem, see ReductionSystem.enable_trace.
+  Each event is a (sequence number, rule, class, key before, key after) tuple, where class is Component or
+  Mixture and the keys are from their key methods, so recording a rewrite never builds strings;
+  see events for readable ones. Only the last |capacity| events are kept. If |sample_rate| is below 1,
+  each rewrite is only recorded with that probability (decided by a random generator of its own, seeded with |seed|).
+  If |failure_path| is given, the events are written there as JSON lines when a reduction fails.
+  """
+  def __init__(self, capacity=1024, sample_rate=1.0, seed=None, failure_path=None):
+    self.buffer = deque(maxlen=capacity)
+    self.sample_rate = sample_rate
+    self.rng = random.Random(seed)
+    self.failure_path = failure_path
+    self.rewrites = 0 # rewrites seen, recorded or not
+    self.reduction_start = 0 # rewrites seen before the current or last reduction, see ReductionSystem.last_trace
+
+  def record(self, rule, before, after):
+    self.rewrites += 1
+    if self.sample_rate < 1 and self.rng.random() >= self.sample_rate:
+      return
+    self.buffer.append((self.rewrites, rule, type(before), before.key(), after.key()))
+
+  def clear(self):
+    self.buffer.clear()
+
+  def __len__(self):
+    return len(self.buffer)
+
+  def events(self, rule_filter=None, last=None, since=None):
+    """ Yield the recorded events, oldest first, as dicts with the sequence number and the strings of the rule
+    and of what it rewrote before and after. Only the |last| events are given if it is not None, only the ones
+    whose rule string contains |rule_filter| if it is not None, and only the ones with a sequence number
+    above |since| if it is not None.
+    """
+    events = list(self.buffer)
+    if since is not None:
+      events = [e for e in events if e[0] > since]
+    if rule_filter is not None:
+      events = [e for e in events if rule_filter in str(e[1])]
+    if last is not None:
+      events = events[-last:] if last else []
+    for seq, rule, cls, before, after in events:
+      from_key = Component.from_ids if cls is Component else Mixture.from_key
+      yield {'seq' : seq, 'rule' : str(rule), 'before' : str(from_key(before)), 'after' : str(from_key(after))}
+
+  def export_jsonl(self, path, failure=None):
+    """ Write the events to |path| as JSON lines. If |failure| is given, it is a dict describing a failed
+    reduction, which goes on the first line.
+    """
+    with open(path, 'w') as f:
+      if failure is not None:
+        print(json.dumps(failure), file=f)
+      for event in self.events():
+        print(json.dumps(event), file=f)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['buffer'] = deque(maxlen=self.buffer.maxlen) # keys are specific to this process
+    return state
+
+
+
 class ReductionSystem:
   """Initialize with a list of ReductionRuleComponent and a list of ReductionRuleMixture
+  Unless use_rule_index is turned off, a RuleIndex is used to skip rules that cannot match.
+  If |cache_size| is given, normal forms are memoized; see enable_cache.
+  |engine| selects how reduce_mixture finds normal forms, and can be changed at any time:
+  - 'fixpoint' applies each rule in turn until no change, over and over until nothing changes
+  - 'agenda' gives the same normal forms with the same passes, but only attempts the rules
+    that might change something since the last pass; see reduce_mixture_agenda
   """
-  def __init__(self, rules):
+  engines = ['fixpoint', 'agenda']
+
+  def __init__(self, rules, cache_size=None, engine='fixpoint'):
+    if engine not in self.engines:
+      raise Exception("Unknown reduction engine '{}'. Options are: {}".format(engine,', '.join(self.engines)))
+    self.type_checker = None # set by set_type_checker
+    self.profiling = False
+    self.trace = None
+    self.normal_form_cache = None
+    self.unchanged_by = LRUCache(16384) # see reduce_mixture_agenda
+    self.use_rule_index = True
     self.rules = rules
     self.max_iterations = 500
     self.debug = False
+    self.engine = engine
+    self.agenda_stats = {'attempts' : 0, 'saved' : 0}
+    if cache_size:
+      self.enable_cache(cache_size)
+
+  @property
+  def rules(self):
+    return self._rules
+
+  @rules.setter
+  def rules(self, rules):
+    self._rules = rules
+    self.invalidate()
+    if self.profiling:
+      self.enable_profiling()
 
+  def invalidate(self):
+    """ Forget everything derived from the rules and type checker: cached normal forms, and the rule index,
+    which is built again right away. This happens automatically when rules is assigned or set_type_checker
+    is called, but it must be called by hand after modifying the rules list in place.
+    """
+    self.rule_index = self.build_rule_index() if self.use_rule_index else None
+    self.unchanged_by.clear()
+    if self.normal_form_cache is not None:
+      self.normal_form_cache.clear()
+
+  def __getstate__(self):
+    # Caches are keyed on symbol ids, which are specific to a process, so a pickled system starts with empty ones
+    state = self.__dict__.copy()
+    state['rule_index'] = None
+    state['unchanged_by'] = LRUCache(self.unchanged_by.maxsize)
+    if self.normal_form_cache is not None:
+      state['normal_form_cache'] = LRUCache(self.normal_form_cache.maxsize)
+    return state
+
+  def enable_cache(self, maxsize=4096):
+    """ Memoize reduce_component and reduce_mixture in an LRUCache holding up to |maxsize| normal forms,
+    keyed on the key() of the Component or Mixture
+    """
+    self.normal_form_cache = LRUCache(maxsize)
+
+  def disable_cache(self):
+    self.normal_form_cache = None
+
+  def cache_info(self):
+    'Return a dict of hit, miss and eviction counters of the normal form cache, or None if it is off'
+    if self.normal_form_cache is None:
+      return None
+    return self.normal_form_cache.info()
+
+  def enable_profiling(self):
+    """ Count attempts, matches, rewrites and fixed point iterations of each rule, and time its matching and
+    substitution, in a RuleProfile attached to the rule as rule.profile. Rules that already have one keep it.
+    Since the counters live on the rules, systems sharing rules share them. See profile_report.
+    """
+    self.profiling = True
+    for rule in self.rules:
+      if rule.profile is None:
+        rule.profile = RuleProfile()
+
+  def disable_profiling(self):
+    'Stop profiling, and drop the profiles'
+    self.profiling = False
+    for rule in self.rules:
+      rule.profile = None
+
+  def reset_profiling(self):
+    'Zero the counters of every rule'
+    for rule in self.rules:
+      if rule.profile is not None:
+        rule.profile = RuleProfile()
+
+  def profile_data(self):
+    'Return a list with a dict of the counters of each profiled rule, the rules taking the most time first'
+    data = []
+    for rule in self.rules:
+      if rule.profile is not None:
+        entry = {'rule' : str(rule)}
+        entry.update(rule.profile.as_dict())
+        entry['total_seconds'] = entry['match_seconds'] + entry['substitution_seconds']
+        data.append(entry)
+    data.sort(key = lambda entry : entry['total_seconds'], reverse=True)
+    return data
+
+  def profile_report(self, limit=None):
+    'Return a table of profile_data as a string, showing only the first |limit| rules if given'
+    lines = ["{:>9} {:>9} {:>9} {:>10} {:>10} {:>10}  {}".format('attempts','matches','rewrites','iterations','match ms','subst ms','rule')]
+    for entry in self.profile_data()[:limit]:
+      lines.append("{attempts:>9} {matches:>9} {rewrites:>9} {iterations:>10} {match_ms:>10.2f} {subst_ms:>10.2f}  {rule}".format(
+        match_ms=1000*entry['match_seconds'], subst_ms=1000*entry['substitution_seconds'], **entry))
+    return '\n'.join(lines)
+
+  def enable_trace(self, capacity=1024, sample_rate=1.0, seed=None, failure_path=None):
+    """ Record the rewrites of each rule in a ReductionTrace with the given parameters, kept as trace.
+    Unlike debug, this prints nothing, and costs little enough to leave on.
+    Return the trace.
+    """
+    self.trace = ReductionTrace(capacity, sample_rate, seed, failure_path)
+    return self.trace
+
+  def disable_trace(self):
+    self.trace = None
+
+  def last_trace(self):
+    """ Return the list of events (see ReductionTrace.events) recorded during the last reduce_mixture,
+    whether it succeeded or failed, or None if tracing is off. Events that did not fit in the trace
+    or were not sampled are missing, and a reduction found in the normal form cache has none.
+    """
+    if self.trace is None:
+      return None
+    return list(self.trace.events(since=self.trace.reduction_start))
+
+  def build_rule_index(self):
+    'Return a RuleIndex of the rules for the type checker they use'
+    type_checker = self.type_checker
+    if type_checker is None and self.rules:
+      rule = self.rules[0]
+      type_checker = (rule.component_rule if isinstance(rule, ReductionRuleComponentAsMixture) else rule).type_checker
+    return RuleIndex(self.rules, type_checker)
+
+  def get_rule_index(self):
+    """ Return the RuleIndex of the rules, or None if use_rule_index is off.
+    The index is built whenever the rules or type checker change, so it is only built here
+    after use_rule_index is turned back on, or after unpickling.
+    """
+    if not self.use_rule_index:
+      return None
+    if self.rule_index is None:
+      self.rule_index = self.build_rule_index()
+    return self.rule_index
+
+  def apply_rule(self, rule, mixture, debug=False):
+    """ Apply |rule| once to the Mixture |mixture| and return the result, like rule.apply,
+    but without trying component rules on components that the rule index rules out
+    """
+    index = self.get_rule_index()
+    if index is None:
+      return rule.apply(mixture, debug)
+    if isinstance(rule, ReductionRuleComponentAsMixture):
+      component_rule = rule.component_rule
+      return mixture_with_components(mixture, [
+        component_rule.apply(c,debug) if component_rule in index.candidates(c) else c
+        for c in mixture.components
+      ])
+    if not index.may_match_mixture(rule, mixture):
+      return mixture
+    return rule.apply(mixture, debug)
+
+  def apply_rule_till_no_change(self, rule, f, x, debug=False):
+    """ Return apply_till_no_change(f, x), where f applies |rule|, counting the iterations in the profile of |rule|
+    and recording the rewrites in the trace
+    """
+    profile = rule.profile
+    trace = self.trace
+    if profile is not None or trace is not None:
+      apply = f
+      def f(x, debug):
+        if profile is not None:
+          profile.iterations += 1
+        y = apply(x, debug)
+        if trace is not None and y is not x:
+          trace.record(rule, x, y)
+        return y
+    return apply_till_no_change(f, x, self.max_iterations, debug, rule)
+
+  def apply_till_no_change(self, f, x, debug=False):
+    """ Return apply_till_no_change(f, x), where f applies many rules. If f goes around a cycle, the
+    ReductionCycleError gets the rules that rewrote each state of the cycle, found by applying f to
+    each of them again while tracing. The replay is left out of agenda_stats and of the rule profiles.
+    """
+    try:
+      return apply_till_no_change(f, x, self.max_iterations, debug)
+    except ReductionCycleError as e:
+      if None not in e.rules:
+        raise
+      trace = self.trace
+      agenda_stats = dict(self.agenda_stats)
+      profiled_rules = [(rule, rule.profile) for rule in self.rules if rule.profile is not None]
+      for rule, _ in profiled_rules:
+        rule.profile = None
+      self.trace = ReductionTrace(capacity=None)
+      try:
+        for i, state in enumerate(e.states):
+          self.trace.clear()
+          f(state, False)
+          e.rules[i] = [event[1] for event in self.trace.buffer]
+      finally:
+        self.trace = trace
+        self.agenda_stats.update(agenda_stats)
+        for rule, profile in profiled_rules:
+          rule.profile = profile
+      raise
+
+  def apply_each_rule(self, mixture, debug=False):
+    'For each rule, apply it to |mixture| until convergence'
+    for rule in self.rules:
+      mixture = self.apply_rule_till_no_change(rule, lambda m,d : self.apply_rule(rule,m,d), mixture, debug)
+    return mixture
 
   def reduce_component(self, component):
     """ Repeatedly apply the component rules until component is fully reduced
         Return reduced form.
         component is a Component
     """
-    component_rules_as_mixture = filter(lambda r : isinstance(r,ReductionRuleComponentAsMixture), self.rules)
-    component_rules = map(lambda r : r.component_rule, component_rules_as_mixture)
-    return apply_till_no_change(
-      lambda c,_ : apply_each_rule_till_no_change(component_rules,c,self.max_iterations, self.debug),
-      component,
-      self.max_iterations,
-      self.debug
-    )
+    cache = self.normal_form_cache
+    if cache is not None:
+      reduced_ids = cache.get(('component',component.ids))
+      if reduced_ids is not MISSING:
+        return Component.from_ids(reduced_ids)
+
+    component_rules = [r.component_rule for r in self.rules if isinstance(r,ReductionRuleComponentAsMixture)]
+    index = self.get_rule_index()
+    def apply_each_component_rule(c, debug):
+      for rule in component_rules:
+        if index is None or rule in index.candidates(c):
+          c = self.apply_rule_till_no_change(rule, rule.apply, c, debug)
+      return c
+    reduced = self.apply_till_no_change(apply_each_component_rule, component, self.debug)
+
+    if cache is not None:
+      cache.put(('component',component.ids), reduced.ids)
+      cache.put(('component',reduced.ids), reduced.ids)
+    return reduced
 
   def reduce_mixture(self, mixture):
     """ First reduce all components of the mixture.
@@ -73,17 +500,223 @@ class ReductionSystem:
         Return reduced form.
         Here |mixture| is assumed to be a Mixture.
     """
-    return apply_till_no_change(
-      lambda m,_ : apply_each_rule_till_no_change(self.rules,m,self.max_iterations, self.debug),
-      mixture,
-      self.max_iterations,
-      self.debug
-    )
+    if self.trace is not None:
+      self.trace.reduction_start = self.trace.rewrites
+    cache = self.normal_form_cache
+    if cache is not None:
+      key = mixture.key()
+      reduced_key = cache.get(('mixture',key))
+      if reduced_key is not MISSING:
+        return Mixture.from_key(reduced_key)
+
+    try:
+      if self.engine=='agenda':
+        reduced = self.reduce_mixture_agenda(mixture)
+      else:
+        reduced = self.apply_till_no_change(self.apply_each_rule, mixture, self.debug)
+    except Exception as e:
+      if self.trace is not None and self.trace.failure_path is not None:
+        self.trace.export_jsonl(self.trace.failure_path, {'failed' : str(mixture), 'error' : str(e)})
+      raise
+
+    if cache is not None:
+      reduced_key = reduced.key()
+      cache.put(('mixture',key), reduced_key)
+      cache.put(('mixture',reduced_key), reduced_key)
+    return reduced
+
+  def reduce_mixture_agenda(self, mixture):
+    """ Reduce |mixture| like the fixpoint engine does, with the same passes, rule order and result,
+    but keeping an agenda of what might still change instead of going over every rule and component:
+    - A component is dirty while some of the component rules that the rule index gives as its candidates
+      are not known to leave it unchanged. unchanged_by maps component ids to a bit mask of those rules,
+      and is kept across calls until the rules or type checker change. Each pass only takes the dirty
+      components through the candidate rules they have left, and drops those that are now clean.
+    - A mixture rule that failed is only tried again after the mixture has changed. If it failed because
+      nothing matched, it also waits for a component to come in that a match could use, see RuleIndex.may_match_with.
+    The attempts made, and the ones of the fixpoint engine skipped, are counted in agenda_stats.
+    """
+    index = self.get_rule_index()
+    component_rules = [] # the component rules in order; the bit of component_rules[i] in unchanged_by is 1<<i
+    segments = [] # runs of consecutive component rules as (start, stop) ranges in component_rules, and mixture rules
+    for rule in self.rules:
+      if isinstance(rule, ReductionRuleComponentAsMixture):
+        if not segments or not isinstance(segments[-1], tuple):
+          segments.append((len(component_rules), len(component_rules)))
+        component_rules.append(rule.component_rule)
+        segments[-1] = (segments[-1][0], len(component_rules))
+      else:
+        segments.append(rule)
+    positions = {}
+    for i, rule in enumerate(component_rules):
+      positions.setdefault(rule, i)
+    unchanged_by = self.unchanged_by
+    stats = self.agenda_stats
+    candidates_by_ids = {} # maps component ids to the sorted positions of their candidate rules, and the mask of their bits
+
+    def candidate_positions(component):
+      entry = candidates_by_ids.get(component.ids)
+      if entry is None:
+        if index is None:
+          found = range(len(component_rules))
+        else:
+          found = sorted(positions[rule] for rule in index.candidates(component) if rule in positions)
+        entry = (found, sum(1 << i for i in found))
+        candidates_by_ids[component.ids] = entry
+      return entry
+
+    def is_clean(component):
+      mask = candidate_positions(component)[1]
+      return unchanged_by.get(component.ids, 0) & mask == mask
+
+    def reduce_component_in_run(component, start, stop, debug):
+      found = candidate_positions(component)[0]
+      i = bisect.bisect_left(found, start)
+      while i < len(found) and found[i] < stop:
+        position = found[i]
+        mask = unchanged_by.get(component.ids, 0)
+        i += 1
+        if mask & (1 << position):
+          continue
+        stats['attempts'] += 1
+        rule = component_rules[position]
+        reduced = self.apply_rule_till_no_change(rule, rule.apply, component, debug)
+        if reduced is component:
+          unchanged_by.put(component.ids, mask | (1 << position))
+        else:
+          component = reduced
+          found = candidate_positions(component)[0]
+          i = bisect.bisect_right(found, position)
+      return component
+
+    # The agenda, which holds for the mixture last returned by reduce_pass
+    last = None
+    dirty = [] # positions of the dirty components
+    changes = 0 # rewrites of the mixture
+    arrivals = [] # components that came into the mixture, in order
+    failed = {} # maps mixture rules to (changes, len(arrivals), whether nothing matched) as of when they last failed
+
+    def reduce_pass(mixture, debug):
+      nonlocal last, dirty, changes, arrivals, failed
+      if mixture is not last: # start afresh, as this is the first pass or the cycle replay of apply_till_no_change
+        dirty = [i for i, component in enumerate(mixture.components) if not is_clean(component)]
+        changes = 0
+        arrivals = []
+        failed = {}
+      for segment in segments:
+        if isinstance(segment, tuple):
+          start, stop = segment
+          attempts = stats['attempts']
+          components = mixture.components
+          for i in dirty:
+            reduced = reduce_component_in_run(components[i], start, stop, debug)
+            if reduced is not components[i]:
+              if components is mixture.components:
+                components = list(components)
+              components[i] = reduced
+              arrivals.append(reduced)
+          if components is not mixture.components:
+            mixture = Mixture(components)
+            changes += 1
+          dirty = [i for i in dirty if not is_clean(components[i])]
+          stats['saved'] += (stop-start)*len(components) - (stats['attempts']-attempts)
+          continue
+        rule = segment
+        if rule in failed:
+          changed, arrived, no_match = failed[rule]
+          if changed==changes or (no_match and index is not None and not index.may_match_with(rule, arrivals[arrived:])):
+            failed[rule] = (changes, len(arrivals), no_match)
+            stats['saved'] += 1
+            continue
+        stats['attempts'] += 1
+        reduced = self.apply_rule_till_no_change(rule, lambda m,d : self.apply_rule(rule,m,d), mixture, debug)
+        if reduced is not mixture:
+          kept = set(map(id, mixture.components))
+          arrivals.extend(c for c in reduced.components if id(c) not in kept)
+          dirty = [i for i, component in enumerate(reduced.components) if not is_clean(component)]
+          mixture = reduced
+          changes += 1
+        no_match = (index is not None and not index.may_match_mixture(rule, mixture)) or rule.match_lhs(mixture) is None
+        failed[rule] = (changes, len(arrivals), no_match)
+      last = mixture
+      return mixture
+
+    return self.apply_till_no_change(reduce_pass, mixture, self.debug)
 
   def set_type_checker(self,type_checker):
     'Set the type checker for all reduction rules'
+    self.type_checker = type_checker
     for rule in self.rules:
       rule.set_type_checker(type_checker)
+    self.invalidate()
 
   def toggle_debug(self):
     self.debug = not self.debug
+
+  def reduce_many(self, mixtures, executor='process', workers=None, chunk_size=64):
+    """ Reduce each Mixture of the iterable |mixtures|, yielding a pair for each in the same order:
+    (reduced mixture, None), or (None, exception) if reducing it raised an exception, such as a time out.
+    The mixtures are sent to the workers in chunks of |chunk_size|, and only a few chunks per worker
+    are in flight at a time, so |mixtures| can be a long or endless stream.
+    |executor| is one of
+    - 'process': a pool of |workers| processes (default: number of cores). Each worker gets a copy of
+      this system, with its rules and type checker, once when it starts, and has its own caches.
+    - 'thread': a pool of |workers| threads. Each thread gets its own copy of this system, made once when
+      it starts, since the caches and counters are not thread safe. Reduction is pure Python, so this
+      only helps when the rules are cheap compared to whatever produces the mixtures.
+    - 'serial': reduce in this thread, one mixture at a time
+    """
+    chunks = iter(functools.partial(lambda it : list(itertools.islice(it, chunk_size)), iter(mixtures)), [])
+    if executor=='serial':
+      for chunk in chunks:
+        yield from reduce_chunk(self, chunk)
+      return
+    workers = workers or os.cpu_count() or 1
+    if executor=='process':
+      pool = ProcessPoolExecutor(workers, initializer=init_reduction_worker, initargs=(self,))
+      task = reduce_chunk_in_worker
+    elif executor=='thread':
+      pool = ThreadPoolExecutor(workers, initializer=init_reduction_thread, initargs=(pickle.dumps(self),))
+      task = reduce_chunk_in_thread
+    else:
+      raise Exception("Unknown executor '{}'. Options are: process, thread, serial".format(executor))
+    pending = deque()
+    try:
+      for chunk in chunks:
+        pending.append(pool.submit(task, chunk))
+        if len(pending) >= 2*workers:
+          yield from pending.popleft().result()
+      while pending:
+        yield from pending.popleft().result()
+    finally:
+      for future in pending:
+        future.cancel()
+      pool.shutdown()
+
+
+def reduce_chunk(reduction_system, mixtures):
+  'Reduce each of the list |mixtures|, returning the pairs described in ReductionSystem.reduce_many'
+  results = []
+  for mixture in mixtures:
+    try:
+      results.append((reduction_system.reduce_mixture(mixture), None))
+    except Exception as e:
+      results.append((None, e))
+  return results
+
+worker_reduction_system = None # the ReductionSystem of a reduce_many worker process
+
+def init_reduction_worker(reduction_system):
+  global worker_reduction_system
+  worker_reduction_system = reduction_system
+
+def reduce_chunk_in_worker(mixtures):
+  return reduce_chunk(worker_reduction_system, mixtures)
+
+thread_worker = threading.local() # holds the copy of the ReductionSystem of a reduce_many worker thread
+
+def init_reduction_thread(pickled_reduction_system):
+  thread_worker.reduction_system = pickle.loads(pickled_reduction_system)
+
+def reduce_chunk_in_thread(mixtures):
+  return reduce_chunk(thread_worker.reduction_system, mixtures)